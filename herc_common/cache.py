@@ -0,0 +1,261 @@
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+
+# default limit of parameters of a query in old SQLite versions
+SQLITE_MAX_VARIABLES = 999
+
+
+def get_many(cache, keys):
+    """ Return a dict with the entries of the given keys found in a dict-like cache. """
+    if isinstance(cache, SqliteCache):
+        return cache.get_many(keys)
+    return {key: cache[key] for key in keys if key in cache}
+
+
+class SqliteCache(MutableMapping):
+    """ Persistent key/value cache stored in a SQLite file.
+
+    This class behaves like a dict, so it can be used anywhere an
+    in-memory cache is expected (e.g. as the `entities_cache` of a
+    :obj:`WikidataGraphBuilder`). Several caches can share the same
+    file by using a different table for each one of them.
+
+    The database is opened in WAL mode, so several processes can read
+    from it while another one is writing. Each process (and each forked
+    worker) opens its own connection the first time it uses the cache.
+
+    Parameters
+    ----------
+    path: str
+        Path of the SQLite file. It is created if it does not exist.
+    table: str (default='cache')
+        Name of the table where the entries of this cache are stored.
+    ttl: float (default=None)
+        Number of seconds an entry is considered valid after it was stored.
+        Expired entries are treated as missing. If None, entries never expire.
+    max_entries: int (default=None)
+        Maximum number of entries kept in the cache. The least recently
+        used ones are evicted when it is exceeded.
+    max_bytes: int (default=None)
+        Maximum size in bytes of the stored values. The least recently
+        used entries are evicted when it is exceeded.
+    timeout: float (default=30.0)
+        Number of seconds to wait for a lock held by another process.
+    """
+
+    def __init__(self, path, table='cache', ttl=None, max_entries=None,
+                 max_bytes=None, timeout=30.0):
+        if not table.isidentifier():
+            raise ValueError(f"Invalid table name: {table}")
+        self.path = path
+        self.table = table
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._conn = None
+        self._pid = None
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        state['_pid'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    @property
+    def conn(self):
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = self._connect()
+            self._pid = os.getpid()
+        return self._conn
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout,
+                               isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                     "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, "
+                     "created REAL NOT NULL, accessed REAL NOT NULL)")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_accessed "
+                     f"ON {self.table} (accessed)")
+        return conn
+
+    def _is_expired(self, created, now):
+        return self.ttl is not None and now - created > self.ttl
+
+    def __getitem__(self, key):
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute(f"SELECT value, created FROM {self.table} WHERE key = ?",
+                                    (key,)).fetchone()
+            if row is None:
+                raise KeyError(key)
+            value, created = row
+            if self._is_expired(created, now):
+                self._execute_write(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                raise KeyError(key)
+            self._execute_write(f"UPDATE {self.table} SET accessed = ? WHERE key = ?",
+                                (now, key))
+        return pickle.loads(value)
+
+    def __contains__(self, key):
+        with self._lock:
+            row = self.conn.execute(f"SELECT created FROM {self.table} WHERE key = ?",
+                                    (key,)).fetchone()
+        return row is not None and not self._is_expired(row[0], time.time())
+
+    def get_many(self, keys):
+        """ Return a dict with the entries of the given keys that are in the cache.
+
+        Entries are read with a single query per chunk of keys, instead
+        of one per key.
+        """
+        now = time.time()
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), SQLITE_MAX_VARIABLES):
+                chunk = keys[start:start + SQLITE_MAX_VARIABLES]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self.conn.execute(f"SELECT key, value, created FROM {self.table} "
+                                         f"WHERE key IN ({placeholders})", chunk).fetchall()
+                found.update((key, value) for key, value, created in rows
+                             if not self._is_expired(created, now))
+            self._execute_write_many(f"UPDATE {self.table} SET accessed = ? WHERE key = ?",
+                                     [(now, key) for key in found])
+        return {key: pickle.loads(value) for key, value in found.items()}
+
+    def __setitem__(self, key, value):
+        self.update({key: value})
+
+    def __delitem__(self, key):
+        with self._lock:
+            cursor = self.conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+        if cursor.rowcount == 0:
+            raise KeyError(key)
+
+    def __iter__(self):
+        with self._lock:
+            keys = [row[0] for row in self.conn.execute(f"SELECT key FROM {self.table}")]
+        return iter(keys)
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def update(self, other=(), **kwargs):
+        """ Store all the given entries in a single transaction. """
+        now = time.time()
+        items = dict(other, **kwargs).items()
+        rows = []
+        for key, value in items:
+            blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            rows.append((key, blob, len(blob), now, now))
+        if not rows:
+            return
+        with self._lock:
+            conn = self.conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(f"INSERT OR REPLACE INTO {self.table} "
+                                 "(key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                                 rows)
+                self._evict(conn)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def clear(self):
+        with self._lock:
+            self.conn.execute(f"DELETE FROM {self.table}")
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+    def purge_expired(self):
+        """ Remove every expired entry from the cache. """
+        if self.ttl is None:
+            return
+        with self._lock:
+            self.conn.execute(f"DELETE FROM {self.table} WHERE created < ?",
+                              (time.time() - self.ttl,))
+
+    def total_bytes(self):
+        """ Return the size in bytes of all the values stored in the cache. """
+        with self._lock:
+            res = self.conn.execute(f"SELECT SUM(size) FROM {self.table}").fetchone()[0]
+        return res or 0
+
+    def _evict(self, conn):
+        if self.max_entries is not None:
+            conn.execute(f"DELETE FROM {self.table} WHERE key IN ("
+                         f"SELECT key FROM {self.table} ORDER BY accessed DESC "
+                         "LIMIT -1 OFFSET ?)", (self.max_entries,))
+        if self.max_bytes is not None:
+            total = conn.execute(f"SELECT SUM(size) FROM {self.table}").fetchone()[0] or 0
+            if total <= self.max_bytes:
+                return
+            to_remove = []
+            for key, size in conn.execute(f"SELECT key, size FROM {self.table} "
+                                          "ORDER BY accessed ASC"):
+                if total <= self.max_bytes:
+                    break
+                to_remove.append((key,))
+                total -= size
+            conn.executemany(f"DELETE FROM {self.table} WHERE key = ?", to_remove)
+
+    @contextmanager
+    def _no_busy_wait(self):
+        # bookkeeping writes give up at once instead of waiting up to
+        # `timeout` seconds for another process to release the write lock
+        self.conn.execute("PRAGMA busy_timeout = 0")
+        try:
+            yield
+        finally:
+            self.conn.execute(f"PRAGMA busy_timeout = {int(self.timeout * 1000)}")
+
+    def _execute_write(self, query, params):
+        # reads must not fail because another process is holding the write lock,
+        # so bookkeeping writes done while reading are skipped in that case
+        with self._no_busy_wait():
+            try:
+                self.conn.execute(query, params)
+            except sqlite3.OperationalError as e:
+                logger.debug("Skipping cache bookkeeping write: %s", e)
+
+    def _execute_write_many(self, query, params):
+        if not params:
+            return
+        with self._no_busy_wait():
+            try:
+                self.conn.execute("BEGIN IMMEDIATE")
+            except sqlite3.OperationalError as e:
+                logger.debug("Skipping cache bookkeeping write: %s", e)
+                return
+            try:
+                self.conn.executemany(query, params)
+                self.conn.execute("COMMIT")
+            except sqlite3.OperationalError as e:
+                self.conn.execute("ROLLBACK")
+                logger.debug("Skipping cache bookkeeping write: %s", e)
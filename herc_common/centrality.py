@@ -0,0 +1,140 @@
+import networkx as nx
+import numpy as np
+import scipy.linalg as sla
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+
+from scipy.sparse.csgraph import connected_components
+
+
+DENSE_MAX_NODES = 2000
+SOLVE_BLOCK_SIZE = 256
+
+
+def information_centrality(g, weight=None, approx_threshold=None, n_projections=256,
+                           seed=None):
+    """ Compute the information centrality of each node of a graph.
+
+    This returns the same values as :func:`networkx.information_centrality`,
+    but it works on a sparse adjacency matrix of the graph with NumPy and
+    SciPy instead of iterating over every pair of nodes in Python.
+
+    The information centrality of a node is the inverse of the sum of the
+    effective resistances between that node and every other one. They are
+    obtained from the inverse of the Laplacian of the graph grounded at one
+    of its nodes, which is computed with a dense Cholesky factorization for
+    small graphs, and with a sparse LU factorization for bigger ones. For
+    graphs with more than `approx_threshold` nodes, effective resistances
+    are estimated with random projections instead (Spielman & Srivastava,
+    2011), which only needs `n_projections` sparse solves.
+
+    Parameters
+    ----------
+    g: :obj:`networkx.Graph`
+        Connected undirected graph.
+    weight: str (default=None)
+        Edge attribute used as the weight of each edge. If None, every
+        edge has weight 1.
+    approx_threshold: int (default=None)
+        Minimum number of nodes of the graph to approximate the results.
+        If None, results are always exact.
+    n_projections: int (default=256)
+        Number of random projections used to approximate the results.
+    seed: int (default=None)
+        Seed of the random projections.
+
+    Returns
+    -------
+    dict of (node, float)
+        Dictionary with the information centrality of each node.
+    """
+    nodes = list(g)
+    n = len(nodes)
+    if n == 0:
+        raise nx.NetworkXPointlessConcept("Connectivity is undefined for the null graph.")
+
+    edges_from, edges_to, weights = _get_edge_arrays(g, nodes, weight)
+    adj = sp.coo_matrix((np.concatenate([weights, weights]),
+                         (np.concatenate([edges_from, edges_to]),
+                          np.concatenate([edges_to, edges_from]))),
+                        shape=(n, n)).tocsr()
+    if connected_components(adj, directed=False, return_labels=False) > 1:
+        raise nx.NetworkXError("Graph not connected.")
+
+    laplacian = (sp.diags(np.asarray(adj.sum(axis=1)).ravel()) - adj).tocsr()
+    # grounding the laplacian at the first node makes it invertible
+    grounded = laplacian[1:, 1:]
+    if approx_threshold is not None and n >= approx_threshold:
+        resistance_sums = _approx_resistance_sums(grounded, edges_from, edges_to,
+                                                  weights, n, n_projections, seed)
+    elif n <= DENSE_MAX_NODES:
+        resistance_sums = _dense_resistance_sums(grounded, n)
+    else:
+        resistance_sums = _sparse_resistance_sums(grounded, n)
+    return {node: 1 / float(value) for node, value in zip(nodes, resistance_sums)}
+
+
+def _get_edge_arrays(g, nodes, weight):
+    index = {node: i for i, node in enumerate(nodes)}
+    edges = [(index[u], index[v], 1 if weight is None else data.get(weight, 1))
+             for u, v, data in g.edges(data=True) if u != v]
+    if not edges:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int), np.empty(0)
+    edges_from, edges_to, weights = zip(*edges)
+    return (np.array(edges_from), np.array(edges_to),
+            np.array(weights, dtype=float))
+
+
+def _factorize(grounded):
+    # a symmetric ordering keeps the fill-in of the factors low for laplacians
+    return spla.splu(grounded.tocsc(), permc_spec='MMD_AT_PLUS_A')
+
+
+def _resistance_sums(diag, row_sums, n):
+    # sum_w R(v, w) = sum_w C[v, v] + C[w, w] - 2 C[v, w], with C the
+    # inverse of the grounded laplacian padded with zeros for the ground node
+    diag = np.concatenate([[0.0], diag])
+    row_sums = np.concatenate([[0.0], row_sums])
+    return n * diag - 2 * row_sums + diag.sum()
+
+
+def _dense_resistance_sums(grounded, n):
+    if n == 1:
+        return np.zeros(1)
+    factor = sla.cho_factor(grounded.toarray())
+    inverse = sla.cho_solve(factor, np.eye(n - 1))
+    return _resistance_sums(np.diag(inverse), inverse.sum(axis=1), n)
+
+
+def _sparse_resistance_sums(grounded, n):
+    lu = _factorize(grounded)
+    row_sums = lu.solve(np.ones(n - 1))
+    diag = np.empty(n - 1)
+    for start in range(0, n - 1, SOLVE_BLOCK_SIZE):
+        end = min(start + SOLVE_BLOCK_SIZE, n - 1)
+        rhs = np.zeros((n - 1, end - start))
+        rhs[np.arange(start, end), np.arange(end - start)] = 1.0
+        cols = lu.solve(rhs)
+        diag[start:end] = cols[np.arange(start, end), np.arange(end - start)]
+    return _resistance_sums(diag, row_sums, n)
+
+
+def _approx_resistance_sums(grounded, edges_from, edges_to, weights, n,
+                            n_projections, seed):
+    # R(v, w) ~= ||Z[v] - Z[w]||^2 with Z = L^+ B^T W^(1/2) Q^T and
+    # Q a random {-1, 1} / sqrt(k) matrix (Johnson-Lindenstrauss)
+    rng = np.random.RandomState(seed)
+    m = len(weights)
+    q = rng.choice([-1.0, 1.0], size=(m, n_projections)) / np.sqrt(n_projections)
+    q *= np.sqrt(weights)[:, None]
+    incidence = sp.coo_matrix((np.concatenate([np.ones(m), -np.ones(m)]),
+                               (np.concatenate([edges_from, edges_to]),
+                                np.concatenate([np.arange(m), np.arange(m)]))),
+                              shape=(n, m)).tocsr()
+    rhs = incidence @ q
+    z = np.zeros((n, n_projections))
+    # any solution of the singular system works, since only differences
+    # between rows of Z are used
+    z[1:] = _factorize(grounded).solve(rhs[1:])
+    sq_norms = np.einsum('ij,ij->i', z, z)
+    return n * sq_norms - 2 * z @ z.sum(axis=0) + sq_norms.sum()
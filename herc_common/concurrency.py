@@ -0,0 +1,108 @@
+import asyncio
+import threading
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+
+
+class AsyncioExecutor():
+    """ Executor that runs coroutine functions in an event loop of its own.
+
+    The loop runs in a background thread, so it can be used from synchronous
+    code and from inside an already running loop (e.g. Jupyter). `submit`
+    returns a :obj:`concurrent.futures.Future`, like the executors of the
+    standard library.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        return asyncio.run_coroutine_threadsafe(fn(*args, **kwargs), self.loop)
+
+    def shutdown(self, wait=True):
+        """ Cancel the coroutines still running and stop the loop. """
+        async def cancel_pending():
+            tasks = [task for task in asyncio.all_tasks()
+                     if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(cancel_pending(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if wait:
+            self._thread.join()
+            self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(wait=True)
+        return False
+
+
+def iter_results(executor, fn, items, max_pending, ordered=True):
+    """ Apply a function to each item with an executor, yielding results as they are ready.
+
+    Only `max_pending` items are submitted to the executor at the same time,
+    so memory is bounded by the work in flight instead of by the number of items.
+
+    Parameters
+    ----------
+    executor: :obj:`concurrent.futures.Executor`
+        Executor used to run the function. Any object with a `submit` method
+        returning a :obj:`concurrent.futures.Future` can be used.
+    fn: callable
+        Function applied to each item.
+    items: iterable
+        Items to be processed. They are consumed lazily.
+    max_pending: int
+        Maximum number of items submitted and not yielded yet.
+    ordered: bool (default=True)
+        If True, results are yielded in the same order as the items. Otherwise,
+        they are yielded as soon as they are completed.
+
+    Yields
+    ------
+    (int, any)
+        Tuple where the first element is the index of the item and the
+        second one is the result of the function for that item.
+    """
+    items = enumerate(items)
+    pending = deque() if ordered else {}
+
+    def submit_next():
+        try:
+            idx, item = next(items)
+        except StopIteration:
+            return False
+        future = executor.submit(fn, item)
+        if ordered:
+            pending.append((idx, future))
+        else:
+            pending[future] = idx
+        return True
+
+    try:
+        while len(pending) < max_pending and submit_next():
+            pass
+
+        while pending:
+            if ordered:
+                idx, future = pending.popleft()
+                result = future.result()
+                submit_next()
+                yield idx, result
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    idx = pending.pop(future)
+                    submit_next()
+                    yield idx, future.result()
+    finally:
+        for future in (f for _, f in pending) if ordered else pending:
+            future.cancel()
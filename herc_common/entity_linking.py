@@ -1,21 +1,60 @@
+import asyncio
 import json
 import logging
+import re
 import requests
-import time
+import unicodedata
+
+from concurrent.futures import ThreadPoolExecutor
 
 from sklearn.base import TransformerMixin, BaseEstimator
-from tqdm.notebook import tqdm
+from tqdm.auto import tqdm
 
+from herc_common.cache import get_many
+from herc_common.concurrency import iter_results
+from herc_common.http_client import HttpClient, RETRY_STATUS_CODES, run_sync
 from herc_common.utils import WIKIDATA_BASE
 
 
 DBPEDIA_BASE = 'http://dbpedia.org'
 DBPEDIA_SPOTLIGHT_BASE = 'http://api.dbpedia-spotlight.org/en'
 DBPEDIA_SPOTLIGHT_MAX_CHARS = 15000
+# the public Spotlight endpoint answers 403 when its rate limit is reached
+DBPEDIA_SPOTLIGHT_RETRY_STATUS_CODES = RETRY_STATUS_CODES | {403}
+SENTENCE_END_RE = re.compile(r'[.!?]\s+')
+WHITESPACE_RE = re.compile(r'\s')
 OWL_SAME_AS = 'http://www.w3.org/2002/07/owl#sameAs'
 
 logger = logging.getLogger(__name__)
 
+
+def _normalize_label(label):
+    return ' '.join(unicodedata.normalize('NFKC', label).casefold().split())
+
+def split_text(text, max_chars):
+    """ Split a text into pieces of at most `max_chars` characters.
+
+    Texts are split after the last end of sentence of each piece or, if
+    there is none, after its last whitespace. Words longer than `max_chars`
+    are split anyway.
+
+    Returns
+    -------
+    list of (int, str)
+        Tuple with the offset of each piece in the text and the piece.
+    """
+    pieces = []
+    start = 0
+    while len(text) - start > max_chars:
+        window = text[start:start + max_chars]
+        cut = max((m.end() for m in SENTENCE_END_RE.finditer(window)), default=0)
+        if cut == 0:
+            cut = max((m.end() for m in WHITESPACE_RE.finditer(window)), default=max_chars)
+        pieces.append((start, window[:cut]))
+        start += cut
+    pieces.append((start, text[start:]))
+    return pieces
+
 def _convert_to_wd(dbpedia_linked_entities):
     """ Links a single entity to Wikidata.
 
@@ -54,43 +93,126 @@ def _convert_to_wd(dbpedia_linked_entities):
 
 
 class DBPediaEntityLinker(BaseEstimator, TransformerMixin):
-    """
+    """ Annotate the entities of texts with DBpedia Spotlight.
+
+    Texts are annotated by `n_workers` threads sharing a pooled
+    :obj:`herc_common.http_client.HttpClient`. Requests rejected because
+    of the rate limit of the service (403) or server errors are retried
+    with exponential backoff up to `max_retries` times.
+
+    Parameters
+    ----------
+    confidence_threshold: float (default=0.4)
+        Minimum confidence of the annotations returned by Spotlight.
+
+    throttling_time: float (default=5)
+        Seconds waited before the first retry of a rejected request.
+        Each following retry waits twice as long.
 
+    n_workers: int (default=1)
+        Number of texts annotated concurrently.
+
+    max_retries: int (default=5)
+        Maximum number of retries of each request before raising an error.
+
+    requests_per_second: float (default=None)
+        Maximum number of requests per second sent to Spotlight. If None,
+        requests are not rate limited.
+
+    spotlight_base: str (default=DBPEDIA_SPOTLIGHT_BASE)
+        Base url of the Spotlight API, e.g. of a local container.
+
+    split_long_texts: bool (default=False)
+        If True, texts longer than `max_chars` are split into pieces (see
+        :func:`split_text`) that are annotated concurrently, and their
+        entities are merged. Otherwise, texts are truncated to `max_chars`.
+
+    max_chars: int (default=DBPEDIA_SPOTLIGHT_MAX_CHARS)
+        Maximum number of characters sent to Spotlight in a single request.
+
+    http_client: :obj:`herc_common.http_client.HttpClient` (default=None)
+        Client used to call Spotlight. If given, `n_workers` only sets the
+        number of concurrent texts, and `throttling_time`, `max_retries`
+        and `requests_per_second` are ignored.
     """
 
-    def __init__(self, confidence_threshold=0.4, throttling_time=5):
+    def __init__(self, confidence_threshold=0.4, throttling_time=5, n_workers=1,
+                 max_retries=5, requests_per_second=None,
+                 spotlight_base=DBPEDIA_SPOTLIGHT_BASE, http_client=None,
+                 split_long_texts=False, max_chars=DBPEDIA_SPOTLIGHT_MAX_CHARS):
         self.confidence = confidence_threshold
         self.throttling_time = throttling_time
+        self.n_workers = n_workers
+        self.max_retries = max_retries
+        self.requests_per_second = requests_per_second
+        self.spotlight_base = spotlight_base
+        self.split_long_texts = split_long_texts
+        self.max_chars = max_chars
+        if http_client is None:
+            http_client = HttpClient(max_in_flight=n_workers,
+                                     requests_per_second=requests_per_second,
+                                     max_retries=max_retries,
+                                     backoff_factor=throttling_time,
+                                     retry_status_codes=DBPEDIA_SPOTLIGHT_RETRY_STATUS_CODES)
+        self.http_client = http_client
     
     def fit(self, X, y=None):
         return self
     
     def transform(self, X, *args, **kwargs):
-        return [self.link_entities(text[:DBPEDIA_SPOTLIGHT_MAX_CHARS])
-                for text in X]
+        X = list(X)
+        if self.split_long_texts:
+            pieces = ((idx, offset, piece) for idx, text in enumerate(X)
+                      for offset, piece in split_text(text, self.max_chars))
+        else:
+            pieces = ((idx, 0, text[:self.max_chars]) for idx, text in enumerate(X))
+
+        annotations = [[] for _ in X]
+        if self.n_workers == 1:
+            for piece in pieces:
+                annotations[piece[0]].extend(self._annotate_piece(piece))
+        else:
+            with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+                for _, (idx, resources) in iter_results(executor, self._annotate_piece_of,
+                                                        pieces, max_pending=2 * self.n_workers):
+                    annotations[idx].extend(resources)
+
+        return [[(surface_form, uri) for _, surface_form, uri in sorted(set(resources))]
+                for resources in annotations]
     
     def link_entities(self, text):
+        """ Annotate the entities of a text.
+
+        Returns
+        -------
+        list of (str, str)
+            Surface form and DBpedia URI of each annotated entity.
         """
-        """
+        return [(resource['@surfaceForm'], resource['@URI'])
+                for resource in self._annotate(text)]
+
+    def _annotate_piece(self, piece):
+        # offsets of the annotations are moved to the position of the piece
+        _, offset, text = piece
+        return [(offset + int(resource['@offset']), resource['@surfaceForm'], resource['@URI'])
+                for resource in self._annotate(text)]
+
+    def _annotate_piece_of(self, piece):
+        return piece[0], self._annotate_piece(piece)
+
+    def _annotate(self, text):
+        if not text.strip():
+            return []
         payload = {'confidence': self.confidence, 'text': text}
-        reqheaders = {'accept': 'application/json'}
-        res = requests.post(f"{DBPEDIA_SPOTLIGHT_BASE}/annotate",
-                            data=payload,
-                            headers={"accept": "application/json"})
-        while res.status_code == 403:
-            logger.warn("DBPedia spotlight limit reached. Retrying in %d seconds...",
-                self.throttling_time)
-            time.sleep(self.throttling_time)
-            res = requests.post(f"{DBPEDIA_SPOTLIGHT_BASE}/annotate",
-                            data=payload,
-                            headers={"accept": "application/json"})
+        res = self.http_client.post(f"{self.spotlight_base}/annotate",
+                                    data=payload,
+                                    headers={"accept": "application/json"})
+        if res.status_code != 200:
+            raise requests.HTTPError(
+                f"Error {res.status_code} calling DBpedia Spotlight", response=res)
         
         res_dict = json.loads(res.content)
-        if 'Resources' not in res_dict:
-            return []
-        
-        return [(resource['@surfaceForm'], resource['@URI'])
-                for resource in res_dict['Resources']]
+        return res_dict.get('Resources', [])
 
 
 class DBPedia2WikidataMapper(BaseEstimator, TransformerMixin):
@@ -122,18 +244,48 @@ class WikidataEntityLinker(BaseEstimator, TransformerMixin):
     This transformer receives entities in a string form, and
     returns a tuple (entity_name, entity_uri) for each entity
     with its original name and URI in Wikidata.
-    """
 
+    The labels of all the documents are deduplicated before calling the
+    Wikidata search API, and the labels that are not cached yet are searched
+    concurrently. Labels are cached after normalizing them (Unicode NFKC,
+    case folding and collapsing whitespace), so different spellings of the
+    same label are only searched once.
 
-    def __init__(self):
-        self.linked_entities_cache = {}
+    Parameters
+    ----------
+    linked_entities_cache: dict-like (default=None)
+        Cache where the URI of each normalized label is stored (None if
+        the label could not be linked). Any mutable mapping can be used, e.g.
+        a :obj:`herc_common.cache.SqliteCache` to keep the results between
+        runs. If None, an in-memory dict is used.
+
+    http_client: :obj:`herc_common.http_client.HttpClient` (default=None)
+        Client used to call the Wikidata API. Its `max_in_flight` is the
+        maximum number of concurrent searches. If None, a client with the
+        default settings is created.
+
+    language: str (default='en')
+        Language of the labels to be searched.
+
+    wikidata_base: str (default=WIKIDATA_BASE)
+        Base url of the Wikidata API to be called.
+    """
+
+    def __init__(self, linked_entities_cache=None, http_client=None, language='en',
+                 wikidata_base=WIKIDATA_BASE):
+        self.linked_entities_cache = {} if linked_entities_cache is None else linked_entities_cache
+        self.http_client = HttpClient() if http_client is None else http_client
+        self.language = language
+        self.wikidata_base = wikidata_base
 
     def fit(self, X, y=None):
         return self
     
     def transform(self, X, *args, **kwargs):
-        return [[self.link_entity(entity) for entity in doc]
-                for doc in tqdm(X)]
+        X = [list(doc) for doc in X]
+        linked_entities = iter(self.link_entities(
+            [entity for doc in X for entity in doc]))
+        return [[next(linked_entities) for _ in doc] for doc in X]
     
     def link_entity(self, entity_label):
         """ Links a single entity to Wikidata.
@@ -149,27 +301,70 @@ class WikidataEntityLinker(BaseEstimator, TransformerMixin):
             Tuple where the first element is the name of the entity,
             and the second one is its 'QID' from Wikidata after linking.
         """
-        if entity_label in self.linked_entities_cache:
-            return (entity_label, self.linked_entities_cache[entity_label])
+        return self.link_entities([entity_label])[0]
+
+    def link_entities(self, entity_labels):
+        """ Links several entities to Wikidata, searching each distinct label only once.
 
-        url = f"{WIKIDATA_BASE}/api.php?action=wbsearchentities&search=" + \
-            f"{entity_label}&language=en&format=json"
-        response = requests.get(url)
+        Parameters
+        ----------
+        entity_labels : list of str
+            Names of the entities to be linked.
+
+        Returns
+        -------
+        list of (str, str)
+            Tuple with the name and the URI of each entity, in the same order.
+        """
+        return run_sync(self.alink_entities(entity_labels))
+
+    async def alink_entities(self, entity_labels):
+        keys = [self._get_cache_key(label) for label in entity_labels]
+        uris = get_many(self.linked_entities_cache, keys)
+        to_search = {}
+        for label, key in zip(entity_labels, keys):
+            if key not in uris:
+                to_search.setdefault(key, label)
+
+        if to_search:
+            found, error = {}, None
+            searches = [self._search_entity(key, label) for key, label in to_search.items()]
+            for search in tqdm(asyncio.as_completed(searches), total=len(searches)):
+                try:
+                    key, uri = await search
+                except Exception as e:
+                    error = error or e
+                    continue
+                found[key] = uri
+            # results already found are kept even if another search failed
+            self.linked_entities_cache.update(found)
+            if error is not None:
+                raise error
+            uris.update(found)
+        return [(label, uris[key]) for label, key in zip(entity_labels, keys)]
+
+    def _get_cache_key(self, entity_label):
+        return f"{self.language}:{_normalize_label(entity_label)}"
+
+    async def _search_entity(self, key, entity_label):
+        params = {
+            'action': 'wbsearchentities',
+            'search': entity_label,
+            'language': self.language,
+            'format': 'json'
+        }
+        response = await self.http_client.aget(f"{self.wikidata_base}/api.php", params=params)
         if response.status_code != 200:
-            raise Error()
-        
+            raise requests.HTTPError(
+                f"Error {response.status_code} searching '{entity_label}' in Wikidata",
+                response=response)
+
         try:
-            content = json.loads(response.text)
-        except:
+            search_results = json.loads(response.text)['search']
+        except (ValueError, KeyError):
             # invalid entity
-            self.linked_entities_cache[entity_label] = None
-            return self.link_entity(entity_label)
+            return key, None
 
-        search_results = content['search']
         if len(search_results) == 0:
-            self.linked_entities_cache[entity_label] = None
-            return self.link_entity(entity_label)
-        
-        self.linked_entities_cache[entity_label] = search_results[0]['concepturi']
-        return self.link_entity(entity_label)
-
+            return key, None
+        return key, search_results[0]['concepturi']
@@ -1,39 +1,176 @@
 import numpy as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
 
 from nltk.corpus import wordnet as wn
 from nltk.corpus.reader.wordnet import WordNetError
 
+from .cache import get_many
+
+
+SIMILARITY_STATS = ['max similarity', 'min similarity', 'mean similarity', 'median similarity']
+
 
 def compute_similarity_scores(topics_base, topics_pred, similarity_func):
     scores_matrix = get_scores_matrix(topics_base, topics_pred, similarity_func)
     return obtain_associations_scores(scores_matrix)
 
+def compute_corpus_similarity_scores(topics_base_list, topics_pred_list, similarity_func,
+                                     similarities_cache=None, n_workers=1):
+    scorer = SynsetSimilarityScorer(similarity_func, n_workers=n_workers,
+                                    similarities_cache=similarities_cache)
+    return scorer.evaluate(topics_base_list, topics_pred_list)
+
 def get_scores_matrix(topics_base, topics_pred, similarity_func):
-    sim_measures = []
-    for topic_p in topics_pred:
-        p_synset = _get_synset(topic_p)
-        if p_synset is None:
-            array_len = len(topics_base)
-            a = np.empty(array_len)
-            a[:] = np.nan
-            sim_measures.append(a)
-            continue
-
-        topic_sim_measures = []
-        for topic_b in topics_base:
-            b_synset = _get_synset(topic_b)
-            if b_synset is None:
-                topic_sim_measures.append(np.nan)
-                continue
+    return SynsetSimilarityScorer(similarity_func).get_scores_matrix(topics_base, topics_pred)
+
+
+class SynsetSimilarityScorer():
+    """ Compute WordNet similarities between topics, reusing synsets and similarities.
+
+    The synset of each distinct word is looked up only once, and the
+    similarity of each distinct pair of synsets is computed only once and
+    stored in `similarities_cache`, so it is reused by later calls.
+
+    Parameters
+    ----------
+    similarity_func : str
+        Name of the similarity method of the synsets (e.g. 'wup_similarity').
+    n_workers : int (default=1)
+        Number of processes used to compute the similarities of new pairs
+        of synsets. If 1, they are computed in the current process.
+    similarities_cache : dict-like (default=None)
+        Cache where the similarity of each pair of synsets is stored, keyed
+        by the measure and the names of both synsets. Any mutable mapping can
+        be used, e.g. a :obj:`herc_common.cache.SqliteCache` to reuse the
+        similarities between runs. If None, an in-memory dict is used.
+    """
+
+    def __init__(self, similarity_func, n_workers=1, similarities_cache=None):
+        self.similarity_func = similarity_func
+        self.n_workers = n_workers
+        self.synsets_cache = {}
+        self.similarities_cache = {} if similarities_cache is None else similarities_cache
+
+    def evaluate(self, topics_base_list, topics_pred_list):
+        """ Compare the predicted topics of many documents with their base topics.
+
+        The synsets and the similarities needed by every document are
+        obtained together, before computing the scores of each document.
+
+        Parameters
+        ----------
+        topics_base_list : list of list of str
+            Base (gold) topics of each document.
+        topics_pred_list : list of list of str
+            Predicted topics of each document.
+
+        Returns
+        -------
+        (:obj:`pandas.DataFrame`, :obj:`pandas.DataFrame`)
+            Tuple with the scores of :func:`obtain_associations_scores` for each
+            document, and the mean, median, min, max and std of each score
+            across the documents. Documents whose scores cannot be computed
+            (e.g. none of their topics has a synset) have NaN scores.
+        """
+        topics_base_list = [list(topics) for topics in topics_base_list]
+        topics_pred_list = [list(topics) for topics in topics_pred_list]
+        if len(topics_base_list) != len(topics_pred_list):
+            raise ValueError("There must be the same number of base and predicted topic lists")
+
+        self.get_synsets({word for topics in topics_base_list + topics_pred_list
+                          for word in topics})
+        docs_synsets = [(_index_synsets(self.get_synsets(topics_pred)),
+                         _index_synsets(self.get_synsets(topics_base)))
+                        for topics_base, topics_pred in zip(topics_base_list, topics_pred_list)]
+        similarities = self._get_similarities(
+            {(p, b) for (unique_pred, _), (unique_base, _) in docs_synsets
+             for p in unique_pred for b in unique_base})
+
+        scores = []
+        for pred_synsets, base_synsets in docs_synsets:
+            scores_matrix = _build_scores_matrix(pred_synsets, base_synsets, similarities)
             try:
-                similarity = getattr(p_synset, similarity_func)(b_synset)
-                topic_sim_measures.append(similarity)
-            except WordNetError:
-                # comparing synsets with different POS
-                topic_sim_measures.append(np.nan)
-                continue
-        sim_measures.append(topic_sim_measures)
-    return np.array(sim_measures)
+                scores.append(obtain_associations_scores(scores_matrix))
+            except ValueError:
+                # no pair of topics could be compared
+                scores.append(dict.fromkeys(SIMILARITY_STATS, np.nan))
+        scores = pd.DataFrame(scores, columns=SIMILARITY_STATS)
+        return scores, scores.agg(['mean', 'median', 'min', 'max', 'std'])
+
+    def get_scores_matrix(self, topics_base, topics_pred):
+        """ Get the similarity of each predicted topic with each base topic.
+
+        Returns
+        -------
+        :obj:`numpy.ndarray`
+            Array of shape (len(topics_pred), len(topics_base)). Topics without
+            a synset, or whose synsets cannot be compared, have a NaN similarity.
+        """
+        pred_synsets = _index_synsets(self.get_synsets(topics_pred))
+        base_synsets = _index_synsets(self.get_synsets(topics_base))
+        similarities = self._get_similarities(
+            [(p, b) for p in pred_synsets[0] for b in base_synsets[0]])
+        return _build_scores_matrix(pred_synsets, base_synsets, similarities)
+
+    def get_synsets(self, words):
+        """ Get the name of the first synset of each word, or None if it has none. """
+        for word in set(words) - self.synsets_cache.keys():
+            synset = _get_synset(word)
+            self.synsets_cache[word] = synset.name() if synset is not None else None
+        return [self.synsets_cache[word] for word in words]
+
+    def _get_similarities(self, pairs):
+        # returns a dict with the similarity of each pair, computing only the missing ones
+        keys = {pair: f"{self.similarity_func}|{pair[0]}|{pair[1]}" for pair in pairs}
+        cached = get_many(self.similarities_cache, keys.values())
+        similarities = {pair: cached[key] for pair, key in keys.items() if key in cached}
+        missing = [pair for pair in keys if pair not in similarities]
+        if missing:
+            computed = dict(zip(missing, self._compute_similarities(missing)))
+            self.similarities_cache.update({keys[pair]: sim for pair, sim in computed.items()})
+            similarities.update(computed)
+        return similarities
+
+    def _compute_similarities(self, pairs):
+        if self.n_workers == 1:
+            return _get_synsets_similarities(pairs, self.similarity_func)
+
+        chunk_size = -(-len(pairs) // (4 * self.n_workers))
+        chunks = [pairs[i:i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+        with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+            results = executor.map(_get_synsets_similarities, chunks,
+                                   [self.similarity_func] * len(chunks))
+            return [sim for chunk in results for sim in chunk]
+
+
+def _get_synsets_similarities(pairs, similarity_func):
+    # synsets are passed by name, since they are cheaper to send to other processes
+    similarities = []
+    for p_name, b_name in pairs:
+        try:
+            similarity = getattr(wn.synset(p_name), similarity_func)(wn.synset(b_name))
+        except WordNetError:
+            # comparing synsets with different POS
+            similarity = None
+        similarities.append(np.nan if similarity is None else similarity)
+    return similarities
+
+def _build_scores_matrix(pred_synsets, base_synsets, similarities):
+    (unique_pred, pred_idx), (unique_base, base_idx) = pred_synsets, base_synsets
+    # a last row and column of NaN are used by the words without synset
+    scores = np.full((len(unique_pred) + 1, len(unique_base) + 1), np.nan)
+    for i, p in enumerate(unique_pred):
+        scores[i, :-1] = [similarities[(p, b)] for b in unique_base]
+    return scores[np.ix_(pred_idx, base_idx)]
+
+def _index_synsets(synsets):
+    # returns the distinct synsets and the position of each synset among them,
+    # with words without synset pointing after the last one
+    unique = list(dict.fromkeys(s for s in synsets if s is not None))
+    positions = {synset: i for i, synset in enumerate(unique)}
+    return unique, np.array([positions.get(s, len(unique)) for s in synsets], dtype=np.intp)
 
 def obtain_associations_scores(scores_matrix):
     scores_matrix = _remove_nan_rows(scores_matrix)
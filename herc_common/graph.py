@@ -1,17 +1,25 @@
+import asyncio
+import heapq
 import json
 import logging
 import networkx as nx
 import networkx.algorithms as nxa
 import pdb
 import requests
+import threading
 
-from herc_common.utils import empty_if_keyerror, WIKIDATA_BASE
+from herc_common.cache import get_many
+from herc_common.http_client import HttpClient, run_sync
+from herc_common.utils import empty_if_keyerror, top_k_keys, WIKIDATA_BASE
 
 
 logger = logging.getLogger(__name__)
 
 WIKIDATA_PROPS_EXPAND = ['P31', 'P279', 'P301', 'P361', 'P366',
                          'P527', 'P910', 'P921', 'P2578', 'P2579']
+WIKIDATA_STOP_QIDS = frozenset(['Q4167410', 'Q4167836', 'Q37517',
+                                'Q16334298', 'Q59541917'])
+WIKIDATA_MAX_IDS_PER_REQUEST = 50
 WIKIDATA_EXTERNAL_IDS = {
     'P349': 'https://id.ndl.go.jp/auth/ndlsh/',
     'P352': 'https://www.uniprot.org/uniprot/',
@@ -33,7 +41,7 @@ def get_centrality_algorithm_results(g, algorithm, stop_uris, top_n):
     ----------
     g: :obj:`networkx.graph`
     algorithm: callable
-    stop_uris: list of str
+    stop_uris: set of str
     top_n: int
 
     Returns
@@ -43,15 +51,49 @@ def get_centrality_algorithm_results(g, algorithm, stop_uris, top_n):
         one is the score obtained for the given algorithm.
     """
     metrics = algorithm(g)
-    metrics = {key: val for key, val in metrics.items()
-                if key not in stop_uris}
-    best_qids = sorted(metrics, key=metrics.get, reverse=True)[:top_n]
+    if not isinstance(stop_uris, (set, frozenset)):
+        stop_uris = frozenset(stop_uris)
+    best_qids = top_k_keys(metrics, top_n, exclude=stop_uris)
     return [(g.nodes[qid], metrics[qid]) for qid in best_qids]
 
 
-def get_largest_connected_subgraph(g):
-    S = [g.subgraph(c).copy() for c in nxa.components.connected_components(g)]
-    return max(S, key=len)
+def get_largest_connected_subgraph(g, copy=True):
+    """ Return the largest connected component of a graph.
+
+    Parameters
+    ----------
+    g: :obj:`networkx.graph`
+    copy: bool (default=True)
+        If True, a copy of the component is returned. Otherwise, a read-only
+        view of the original graph is returned, and no node or edge is copied.
+
+    Returns
+    -------
+    :obj:`networkx.graph`
+        Subgraph with the nodes of the largest component. If several
+        components have the same size, the first one found is returned.
+    """
+    largest = max(nxa.components.connected_components(g), key=len)
+    subgraph = g.subgraph(largest)
+    return subgraph.copy() if copy else subgraph
+
+
+def get_largest_connected_subgraphs(g, k):
+    """ Return the k largest connected components of a graph as read-only views.
+
+    Parameters
+    ----------
+    g: :obj:`networkx.graph`
+    k: int
+
+    Returns
+    -------
+    list of :obj:`networkx.graph`
+        Views of the original graph with the nodes of each component, sorted
+        by size in descending order.
+    """
+    components = heapq.nlargest(k, nxa.components.connected_components(g), key=len)
+    return [g.subgraph(c) for c in components]
 
 def _build_uri(entity_id):
     return f"http://www.wikidata.org/entity/{entity_id}"
@@ -67,7 +109,10 @@ def _get_desc(entity_info, lang='en'):
     return entity_info['descriptions'][lang]['value']
 
 def _get_uris(entity_info, term_id):
-    res = [f"{WIKIDATA_BASE}/{term_id}"]
+    return [f"{WIKIDATA_BASE}/{term_id}"] + _get_external_uris(entity_info)
+
+def _get_external_uris(entity_info):
+    res = []
     for claim_key, claim_values in entity_info['claims'].items():
         if claim_key not in WIKIDATA_EXTERNAL_IDS.keys():
             continue
@@ -88,10 +133,60 @@ def _get_labels(entity_info, lang='en'):
     return entity_info['labels'][lang]['value']
 
 
+class WikidataEntity():
+    """ Compact record with the info of a Wikidata entity used to build graphs.
+
+    Only the fields read by :obj:`WikidataGraphBuilder` are kept from the
+    JSON returned by the Wikidata API, so entities take much less memory
+    when they are cached.
+
+    Parameters
+    ----------
+    label: str
+        Label of the entity in English.
+    labels: tuple of str
+        Labels of the entity, aligned with the languages of the builder.
+    descs: tuple of str
+        Descriptions of the entity, aligned with the languages of the builder.
+    uris: tuple of str
+        External URIs of the entity, without its Wikidata URI.
+    neighbours: tuple of str
+        QIDs of the entities linked through the properties expanded by the
+        builder. None if the entity does not exist or has no claims.
+    """
+
+    __slots__ = ('label', 'labels', 'descs', 'uris', 'neighbours')
+
+    def __init__(self, label, labels, descs, uris, neighbours):
+        self.label = label
+        self.labels = labels
+        self.descs = descs
+        self.uris = uris
+        self.neighbours = neighbours
+
+    @property
+    def missing(self):
+        return self.neighbours is None
+
+    def __repr__(self):
+        return f"WikidataEntity({self.label!r})"
+
+
+MISSING_ENTITY = WikidataEntity('', (), (), (), None)
+
+
 class WikidataGraphBuilder():
     """ Build a Wikidata graph from a given set of seed concepts.
 
-    This class can be used to build a graph with Wikidata
+    This class can be used to build a graph with Wikidata. The neighbourhood
+    of the seed concepts is downloaded level by level (breadth-first), requesting
+    every unseen entity of a hop in batches of up to `batch_size` ids per
+    `wbgetentities` call. The batches of a hop are requested concurrently. The
+    graph is then assembled from the downloaded entities.
+
+    Graphs can be built from a coroutine with `abuild_graph`, so a single event
+    loop can build the graphs of many documents at the same time sharing the
+    connection pool of the builder.
 
     Parameters
     ----------
@@ -102,60 +197,232 @@ class WikidataGraphBuilder():
     additional_props: list of str (default=None)
         List of properties to be expanded for each node in the graph. They
         will be added to the default list of properties of the graph builder.
+
+    languages: list of str (default=['en', 'es'])
+        Languages of the labels and descriptions stored in each node.
+
+    batch_size: int (default=50)
+        Maximum number of entities requested in a single call to the
+        Wikidata API. Wikidata does not allow more than 50.
+
+    wikidata_base: str (default=WIKIDATA_BASE)
+        Base url of the Wikidata API to be called.
+
+    entities_cache: dict-like (default=None)
+        Cache where the downloaded entities are stored as :obj:`WikidataEntity`
+        records, keyed by QID. Any mutable mapping can be used, e.g. a
+        :obj:`herc_common.cache.SqliteCache` to share entities between processes
+        and runs. Records depend on the languages and properties of the builder,
+        so a cache should only be shared by builders configured the same way.
+        If None, an in-memory dict is used.
+
+    http_client: :obj:`herc_common.http_client.HttpClient` (default=None)
+        Client used to call the Wikidata API. It controls the maximum number
+        of requests in flight, rate limiting and retries. If None, a client
+        with the default settings is created.
+
+    shared_graph: bool (default=False)
+        If True, a single graph with the neighbourhood of every document is
+        kept by the builder, and it is extended as new seed concepts arrive.
+        The graph of each document is extracted from it without visiting the
+        entities again, and node attributes are computed only once per entity.
+        The 'n' attribute of each node is its minimum distance to the seeds.
     """
 
-    def __init__(self, max_hops=2, additional_props=None, languages=['en', 'es']):
-        self.entities_cache = {}
+    def __init__(self, max_hops=2, additional_props=None, languages=['en', 'es'],
+                 batch_size=WIKIDATA_MAX_IDS_PER_REQUEST, wikidata_base=WIKIDATA_BASE,
+                 entities_cache=None, http_client=None, shared_graph=False):
+        self.entities_cache = {} if entities_cache is None else entities_cache
+        self.http_client = HttpClient() if http_client is None else http_client
+        self.shared_graph = shared_graph
         self.max_hops = max_hops
         self.languages = languages
+        self.batch_size = min(batch_size, WIKIDATA_MAX_IDS_PER_REQUEST)
+        self.wikidata_base = wikidata_base
         self.props_to_expand = WIKIDATA_PROPS_EXPAND
         if additional_props:
             self.props_to_expand += additional_props
+        self._init_shared_graph()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_shared_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._shared_lock = threading.RLock()
+
+    def _init_shared_graph(self):
+        # directed, since only the properties of expanded nodes create edges
+        self._corpus_graph = nx.DiGraph()
+        self._corpus_missing = set()
+        self._corpus_expanded = set()
+        self._shared_lock = threading.RLock()
 
     def build_graph(self, terms):
         """Build the graph for the given terms."""
+        return run_sync(self.abuild_graph(terms))
+
+    async def abuild_graph(self, terms):
+        """Build the graph for the given terms from a coroutine."""
         logger.info("Started building graph.")
+        seed_ids = [term[1].split('/')[-1] for term in terms
+                    if term[1] is not None]
+        if self.shared_graph:
+            G = await self._build_from_shared_graph(seed_ids)
+            logger.info("Finished building graph.")
+            return G
+
         G = nx.Graph()
+        entities = await self._fetch_neighbourhood(seed_ids)
+        expanded = {}
         for term in terms:
             logger.debug("Seed term: %s", term[0])
             term_uri = term[1]
             if term_uri is not None:
                 term_id = term_uri.split('/')[-1]
-                self._add_wd_node_info(G, term_id, None, 0)
+                self._add_wd_node_info(G, term_id, None, 0, entities, expanded)
         logger.info("Finished building graph.")
         return G
 
-    def _add_wd_node_info(self, graph, term_id, prev_node, curr_hop):
-        logger.debug("Visiting entity '%s' - Curr hop: %d", term_id, curr_hop)
-        if curr_hop > self.max_hops or term_id in ['Q4167410', 'Q4167836', 'Q37517',
-            'Q16334298', 'Q59541917']:
-            return
+    async def _fetch_neighbourhood(self, seed_ids):
+        """ Download every entity up to `max_hops` from the seeds, one hop at a time.
+
+        Entities are stored in the cache of the builder, and the ones visited
+        are returned so the graph can be assembled afterwards without any
+        other call to the API or the cache.
+        """
+        entities = {}
+        seen = set()
+        frontier = []
+        for term_id in seed_ids:
+            if term_id not in seen and term_id not in WIKIDATA_STOP_QIDS:
+                seen.add(term_id)
+                frontier.append(term_id)
+
+        for curr_hop in range(self.max_hops + 1):
+            if not frontier:
+                break
+            logger.debug("Fetching %d entities at hop %d", len(frontier), curr_hop)
+            entities.update(await self._get_entities(frontier))
+            if curr_hop == self.max_hops:
+                break
+
+            next_frontier = []
+            for term_id in frontier:
+                for new_node_id in self._get_expandable_ids(entities[term_id]):
+                    if new_node_id in seen or new_node_id in WIKIDATA_STOP_QIDS:
+                        continue
+                    seen.add(new_node_id)
+                    next_frontier.append(new_node_id)
+            frontier = next_frontier
+        return entities
+
+    async def _build_from_shared_graph(self, seed_ids):
+        hops = {}
+        seen = set()
+        frontier = []
+        for term_id in seed_ids:
+            if term_id not in seen and term_id not in WIKIDATA_STOP_QIDS:
+                seen.add(term_id)
+                frontier.append(term_id)
+        await self._add_shared_nodes(frontier)
+
+        for curr_hop in range(self.max_hops + 1):
+            with self._shared_lock:
+                frontier = [term_id for term_id in frontier
+                            if term_id in self._corpus_graph]
+                not_expanded = [term_id for term_id in frontier
+                                if term_id not in self._corpus_expanded]
+            hops.update((term_id, curr_hop) for term_id in frontier)
+            if curr_hop == self.max_hops or not frontier:
+                break
+
+            await self._expand_shared_nodes(not_expanded)
+            next_frontier = []
+            with self._shared_lock:
+                for term_id in frontier:
+                    for new_node_id in self._corpus_graph.successors(term_id):
+                        if new_node_id not in seen:
+                            seen.add(new_node_id)
+                            next_frontier.append(new_node_id)
+            frontier = next_frontier
 
-        if term_id not in self.entities_cache:
-            entity_info = self._fetch_entity_info_of(term_id)
-            self.entities_cache[term_id] = entity_info
-        else:
-            entity_info = self.entities_cache[term_id]
+        G = nx.Graph()
+        with self._shared_lock:
+            corpus_nodes = self._corpus_graph.nodes
+            G.add_nodes_from((term_id, corpus_nodes[term_id]) for term_id in hops)
+            for term_id, curr_hop in hops.items():
+                G.nodes[term_id]['n'] = curr_hop
+            G.add_edges_from((term_id, new_node_id)
+                             for term_id, curr_hop in hops.items()
+                             if curr_hop < self.max_hops
+                             for new_node_id in self._corpus_graph.successors(term_id))
+        return G
 
+    async def _add_shared_nodes(self, term_ids):
+        with self._shared_lock:
+            unknown = [term_id for term_id in term_ids
+                       if term_id not in self._corpus_graph
+                       and term_id not in self._corpus_missing]
+        entities = await self._get_entities(unknown)
+        with self._shared_lock:
+            for term_id, entity in entities.items():
+                if entity.missing:
+                    self._corpus_missing.add(term_id)
+                else:
+                    self._corpus_graph.add_node(term_id, **self._get_node_attrs(term_id, entity))
+
+    async def _expand_shared_nodes(self, term_ids):
+        entities = await self._get_entities(term_ids)
+        new_node_ids = [new_node_id for entity in entities.values()
+                        for new_node_id in entity.neighbours
+                        if new_node_id not in WIKIDATA_STOP_QIDS]
+        await self._add_shared_nodes(list(dict.fromkeys(new_node_ids)))
+        with self._shared_lock:
+            for term_id, entity in entities.items():
+                self._corpus_graph.add_edges_from(
+                    (term_id, new_node_id) for new_node_id in entity.neighbours
+                    if new_node_id in self._corpus_graph)
+                self._corpus_expanded.add(term_id)
+
+    def _get_node_attrs(self, term_id, entity):
+        return {
+            'qid': term_id,
+            'descs': dict(zip(self.languages, entity.descs)),
+            'labels': dict(zip(self.languages, entity.labels)),
+            'label': entity.label,
+            'uris': [f"{WIKIDATA_BASE}/{term_id}", *entity.uris]
+        }
+
+    async def _get_entities(self, term_ids):
+        """Return the info of the given entities, fetching the ones not cached."""
+        term_ids = list(dict.fromkeys(term_ids))
+        res = get_many(self.entities_cache, term_ids)
+        missing = [term_id for term_id in term_ids if term_id not in res]
+
+        batches = [missing[i:i + self.batch_size]
+                   for i in range(0, len(missing), self.batch_size)]
+        results = await asyncio.gather(*[self._fetch_entities_info_of(batch)
+                                         for batch in batches])
+        for entities_info in results:
+            fetched = {term_id: self._to_entity_record(entity_info)
+                       for term_id, entity_info in entities_info.items()}
+            self.entities_cache.update(fetched)
+            res.update(fetched)
+        return res
+
+    def _get_expandable_ids(self, entity):
+        if entity.missing:
+            return ()
+        return entity.neighbours
+
+    def _to_entity_record(self, entity_info):
         if 'claims' not in entity_info:
-            return
-
-        if term_id not in graph.nodes:
-            graph.add_node(term_id)
-            #graph.nodes[term_id]['alias'] = _get_aliases(entity_info)
-            graph.nodes[term_id]['qid'] = term_id
-            graph.nodes[term_id]['descs'] = {lang: _get_desc(entity_info, lang)
-                for lang in self.languages}
-            graph.nodes[term_id]['labels'] = {lang: _get_labels(entity_info, lang)
-                for lang in self.languages}
-            graph.nodes[term_id]['label'] = _get_labels(entity_info)
-            graph.nodes[term_id]['uris'] = _get_uris(entity_info, term_id)
-            graph.nodes[term_id]['n'] = curr_hop
-
-        if prev_node is not None and not graph.has_edge(prev_node, term_id):
-            graph.add_edge(prev_node, term_id)
-
+            return MISSING_ENTITY
 
+        neighbours = []
         for claim_key, claim_values in entity_info['claims'].items():
             if claim_key not in self.props_to_expand:
                 continue
@@ -165,15 +432,60 @@ class WikidataGraphBuilder():
                 if snaktype in ['novalue', 'somevalue']:
                     continue
 
-                new_node_id = value['mainsnak']['datavalue']['value']['id']
-                self._add_wd_node_info(graph, new_node_id, term_id, curr_hop + 1)
+                neighbours.append(value['mainsnak']['datavalue']['value']['id'])
+
+        return WikidataEntity(
+            _get_labels(entity_info),
+            tuple(_get_labels(entity_info, lang) for lang in self.languages),
+            tuple(_get_desc(entity_info, lang) for lang in self.languages),
+            tuple(_get_external_uris(entity_info)),
+            tuple(neighbours))
+
+    def _add_wd_node_info(self, graph, term_id, prev_node, curr_hop, entities, expanded):
+        logger.debug("Visiting entity '%s' - Curr hop: %d", term_id, curr_hop)
+        if curr_hop > self.max_hops or term_id in WIKIDATA_STOP_QIDS:
+            return
+
+        entity = entities[term_id]
+
+        if entity.missing:
+            return
+
+        if term_id not in graph.nodes:
+            graph.add_node(term_id, **self._get_node_attrs(term_id, entity))
+            graph.nodes[term_id]['n'] = curr_hop
+
+        if prev_node is not None and not graph.has_edge(prev_node, term_id):
+            graph.add_edge(prev_node, term_id)
+
+        # a node whose expansion already finished at this hop or a lower one
+        # cannot add new nodes or edges to the graph
+        if expanded.get(term_id, self.max_hops + 1) <= curr_hop:
+            return
+
+        for new_node_id in self._get_expandable_ids(entity):
+            self._add_wd_node_info(graph, new_node_id, term_id, curr_hop + 1,
+                                   entities, expanded)
+        expanded[term_id] = curr_hop
 
-    def _fetch_entity_info_of(self, term_id):
-        endpoint = f"{WIKIDATA_BASE}/api.php?action=wbgetentities&ids={term_id}&languages=en|es&format=json"
-        res = requests.get(endpoint)
+    async def _fetch_entities_info_of(self, term_ids):
+        ids = '|'.join(term_ids)
+        languages = '|'.join(dict.fromkeys(['en', *self.languages]))
+        endpoint = f"{self.wikidata_base}/api.php?action=wbgetentities&ids={ids}&languages={languages}&format=json"
+        res = await self.http_client.aget(endpoint)
         if res.status_code != 200:
-            logger.warning("There was an error calling endpoint for term %s: %s",
-                            term_id, res.content)
-            raise Error()
+            logger.warning("There was an error calling endpoint for terms %s: %s",
+                            ids, res.content)
+            raise requests.HTTPError(res.content, response=res)
         content = json.loads(res.text)
-        return content['entities'][term_id]
+        if 'error' in content:
+            if len(term_ids) == 1:
+                logger.warning("Error fetching term %s: %s", ids, content['error'])
+                return {term_ids[0]: {}}
+            # a single invalid id makes the whole batch fail, so retry them one by one
+            results = await asyncio.gather(*[self._fetch_entities_info_of([term_id])
+                                             for term_id in term_ids])
+            return {term_id: entity_info for result in results
+                    for term_id, entity_info in result.items()}
+        entities = content['entities']
+        return {term_id: entities.get(term_id, {}) for term_id in term_ids}
@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+
+from requests.adapters import HTTPAdapter
+
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+
+
+def run_sync(coro):
+    """ Run a coroutine until it finishes and return its result.
+
+    If an event loop is already running in the current thread (e.g. inside
+    a Jupyter notebook), the coroutine is run in a new loop in another thread.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+class TokenBucket():
+    """ Thread-safe token bucket used to limit the rate of requests.
+
+    Parameters
+    ----------
+    rate: float
+        Number of tokens added to the bucket per second.
+    capacity: float (default=None)
+        Maximum number of tokens in the bucket, i.e. the size of the bursts
+        allowed. If None, it is the same as the rate (at least 1).
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Take a token from the bucket, waiting until one is available. """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class HttpClient():
+    """ Pooled HTTP client with bounded concurrency, rate limiting and retries.
+
+    Requests are sent through a single :obj:`requests.Session`, so connections
+    are reused between calls. They can be made synchronously (`get`, `post`)
+    or from a coroutine (`aget`, `apost`). At most `max_in_flight` requests
+    are sent at the same time, no matter how many event loops or threads
+    share the client.
+
+    Parameters
+    ----------
+    max_in_flight: int (default=8)
+        Maximum number of concurrent requests.
+    requests_per_second: float (default=None)
+        Maximum number of requests per second sent to each host. If None,
+        requests are not rate limited.
+    max_retries: int (default=3)
+        Number of times a request is retried after a connection error or
+        a response with a status code in `retry_status_codes`.
+    backoff_factor: float (default=0.5)
+        Retry number n waits `backoff_factor * 2 ** n` seconds, unless
+        the server sends a Retry-After header.
+    timeout: float (default=30)
+        Timeout in seconds of each request.
+    retry_status_codes: set of int (default=RETRY_STATUS_CODES)
+        Status codes of the responses that will be retried.
+    """
+
+    def __init__(self, max_in_flight=8, requests_per_second=None, max_retries=3,
+                 backoff_factor=0.5, timeout=30, retry_status_codes=RETRY_STATUS_CODES):
+        self.max_in_flight = max_in_flight
+        self.requests_per_second = requests_per_second
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.retry_status_codes = retry_status_codes
+        self._init_resources()
+
+    def _init_resources(self):
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.max_in_flight)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+        self._slots = threading.BoundedSemaphore(self.max_in_flight)
+        self._buckets = {}
+        self._buckets_lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ['_session', '_executor', '_slots', '_buckets', '_buckets_lock']:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_resources()
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    async def aget(self, url, **kwargs):
+        return await self.arequest('GET', url, **kwargs)
+
+    async def apost(self, url, **kwargs):
+        return await self.arequest('POST', url, **kwargs)
+
+    async def arequest(self, method, url, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, lambda: self.request(method, url, **kwargs))
+
+    def request(self, method, url, **kwargs):
+        """ Send a request, retrying it with exponential backoff if it fails.
+
+        Returns the last response received, even if its status code is still
+        one of the retried ones. Connection errors are raised once all the
+        retries have been used.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        bucket = self._get_bucket(url)
+        attempt = 0
+        while True:
+            if bucket is not None:
+                bucket.acquire()
+            try:
+                with self._slots:
+                    res = self._session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.max_retries:
+                    raise
+                logger.warning("Error calling %s (%s). Retrying...", url, e)
+                delay = self._get_backoff(attempt)
+            else:
+                if res.status_code not in self.retry_status_codes or \
+                        attempt >= self.max_retries:
+                    return res
+                logger.warning("Got status %d calling %s. Retrying...",
+                               res.status_code, url)
+                delay = self._get_backoff(attempt, res)
+            time.sleep(delay)
+            attempt += 1
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self._session.close()
+
+    def _get_backoff(self, attempt, res=None):
+        if res is not None:
+            retry_after = res.headers.get('Retry-After')
+            if retry_after is not None and retry_after.isdigit():
+                return float(retry_after)
+        return self.backoff_factor * 2 ** attempt
+
+    def _get_bucket(self, url):
+        if self.requests_per_second is None:
+            return None
+        host = urlsplit(url).netloc
+        with self._buckets_lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.requests_per_second)
+            return self._buckets[host]
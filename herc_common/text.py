@@ -1,15 +1,28 @@
+import hashlib
+import os
+import pickle
 import string
+import zlib
 
 import matplotlib.pyplot as plt
+import numpy as np
 import spacy
 
-from collections import Counter
+from collections import Counter, deque
+from itertools import islice
 
 from sklearn.base import TransformerMixin, BaseEstimator
 from spacy import displacy
-from tqdm.notebook import tqdm
+from spacy.attrs import LEMMA
+from spacy.tokens import Doc, Span
+from tqdm.auto import tqdm
 from wordcloud import WordCloud
 
+from .cache import SqliteCache
+
+
+ANNOTATOR_DISABLED_COMPONENTS = ['parser']
+
 
 def plot_word_cloud(text):
     wordcloud = WordCloud(max_font_size=50, max_words=100, background_color="white").generate(text)
@@ -19,32 +32,204 @@ def plot_word_cloud(text):
     plt.show()
 
 
+def get_doc_tokens(doc, stop_words=frozenset()):
+    """ Get the lemmas of the tokens of a spaCy Doc that are not stop words,
+    punctuation or numbers. `stop_words` must be lowercase. """
+    return [t.lemma_ for t in doc if len(t.text) > 2 and
+            not (t.is_stop or t.lower_ in stop_words) and t.text not in string.punctuation
+            and t.is_alpha and not t.is_digit]
+
+
+def get_doc_entities(doc, disabled_labels=()):
+    """ Get the text of the entities of a spaCy Doc whose label is not disabled. """
+    return [x.text for x in doc.ents
+            if x.label_ not in disabled_labels
+            and len(x.text) > 2]
+
+
+def filter_entities(entities, min_entity_counts=None, max_entities=None):
+    """ Keep the `max_entities` most common entities of a text that
+    appear at least `min_entity_counts` times. """
+    if min_entity_counts is None:
+        return entities
+    return [entity_label
+            for entity_label, entity_count in Counter(entities).most_common(max_entities)
+            if entity_count >= min_entity_counts]
+
+
+class DocCache():
+    """ On-disk cache of the spaCy annotations of texts.
+
+    Docs are stored in a compact format with only the attributes needed by
+    this module (the words, their lemmas and the entities), keyed by a hash
+    of the text and the name, version and components of the model. Texts
+    already in the cache are loaded instead of parsed again. Lexical
+    attributes (e.g. `is_stop`) come from the vocabulary of the model.
+
+    Parameters
+    ----------
+    path : str
+        Path of the SQLite file where the annotations are stored.
+    max_bytes : int (default=None)
+        Maximum size of the stored annotations. The least recently used
+        ones are evicted when it is exceeded.
+    max_entries : int (default=None)
+        Maximum number of stored Docs.
+    table : str (default='spacy_docs')
+        Table of the SQLite file used by the cache.
+    """
+
+    def __init__(self, path, max_bytes=None, max_entries=None, table='spacy_docs'):
+        self.store = SqliteCache(path, table=table, max_bytes=max_bytes,
+                                 max_entries=max_entries)
+
+    def __len__(self):
+        return len(self.store)
+
+    def total_bytes(self):
+        """ Return the size in bytes of the stored annotations. """
+        return self.store.total_bytes()
+
+    def clear(self):
+        self.store.clear()
+
+    def pipe(self, nlp, texts, batch_size=1000, n_process=1):
+        """ Yield the Doc of each text, parsing only the ones not in the cache.
+
+        Texts are read in chunks of `batch_size` (times `n_process`, if
+        greater than 1). The cached Docs of a chunk are loaded with a single
+        query, and its missing texts are sent to a single `nlp.pipe` call
+        shared by the whole stream, so the worker processes are started only
+        once. The new Docs are stored in batches of the size of a chunk.
+
+        Parameters
+        ----------
+        nlp : :obj:`spacy.language.Language`
+            spaCy pipeline used to parse the texts.
+        texts : iterable of str
+            Texts to be annotated. They are consumed lazily.
+        batch_size : int (default=1000)
+            Number of texts processed together by spaCy.
+        n_process : int (default=1)
+            Number of processes used by spaCy to parse the missing texts.
+            -1 uses every available CPU.
+
+        Yields
+        ------
+        :obj:`spacy.tokens.Doc`
+            Doc of each text, in the same order as the texts.
+        """
+        if n_process == -1:
+            n_process = os.cpu_count()
+        model_key = self._get_model_key(nlp)
+        chunk_size = batch_size * max(1, n_process)
+        texts = iter(texts)
+        # keys and cached data (None if missing) of the texts read and not yielded yet
+        pending = deque()
+        to_parse = deque()
+        stopped = False
+
+        def read_chunk():
+            chunk = list(islice(texts, chunk_size))
+            keys = [self._get_key(model_key, text) for text in chunk]
+            cached = self.store.get_many(keys)
+            for text, key in zip(chunk, keys):
+                pending.append((key, cached.get(key)))
+                if key not in cached:
+                    to_parse.append(text)
+            return bool(chunk)
+
+        def missing_texts():
+            while not stopped and (to_parse or read_chunk()):
+                while to_parse and not stopped:
+                    yield to_parse.popleft()
+
+        docs = nlp.pipe(missing_texts(), batch_size=batch_size, n_process=n_process)
+        to_store = {}
+        try:
+            while pending or read_chunk():
+                key, data = pending.popleft()
+                if data is None:
+                    doc = next(docs)
+                    to_store[key] = self._serialize(doc)
+                    if len(to_store) >= chunk_size:
+                        self.store.update(to_store)
+                        to_store = {}
+                else:
+                    doc = self._deserialize(nlp.vocab, data)
+                yield doc
+        finally:
+            # if the Docs are not all consumed, the texts already sent to spaCy are
+            # parsed before closing it, otherwise its worker processes can block
+            stopped = True
+            missing_keys = [key for key, data in pending if data is None]
+            for key, doc in zip(missing_keys, docs):
+                to_store[key] = self._serialize(doc)
+            docs.close()
+            if to_store:
+                self.store.update(to_store)
+
+    @staticmethod
+    def _serialize(doc):
+        # words and lemmas are stored as indices of a list of unique strings
+        string_ids = {}
+        ids = [string_ids.setdefault(t.text, len(string_ids)) for t in doc] + \
+              [string_ids.setdefault(t.lemma_, len(string_ids)) for t in doc]
+        data = (list(string_ids), np.array(ids, dtype=np.uint32),
+                np.array([bool(t.whitespace_) for t in doc]),
+                [(ent.start, ent.end, ent.label_) for ent in doc.ents])
+        return zlib.compress(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+
+    @staticmethod
+    def _deserialize(vocab, data):
+        strings, ids, spaces, ents = pickle.loads(zlib.decompress(data))
+        n = len(spaces)
+        doc = Doc(vocab, words=[strings[i] for i in ids[:n]], spaces=spaces.tolist())
+        hashes = np.array([vocab.strings.add(string) for string in strings], dtype=np.uint64)
+        doc.from_array([LEMMA], hashes[ids[n:]].reshape(-1, 1))
+        doc.ents = [Span(doc, start, end, label=label) for start, end, label in ents]
+        return doc
+
+    @staticmethod
+    def _get_model_key(nlp):
+        meta = nlp.meta
+        return (f"{meta.get('lang')}_{meta.get('name')}-{meta.get('version')}:"
+                f"{','.join(nlp.pipe_names)}")
+
+    @staticmethod
+    def _get_key(model_key, text):
+        return hashlib.sha256(f"{model_key}\n{text}".encode('utf-8')).hexdigest()
+
+
+def pipe_docs(nlp, texts, batch_size=1000, n_process=1, doc_cache=None):
+    """ Parse texts with `nlp.pipe`, loading them from a :obj:`DocCache` if given. """
+    if doc_cache is None:
+        return nlp.pipe(texts, batch_size=batch_size, n_process=n_process)
+    return doc_cache.pipe(nlp, texts, batch_size=batch_size, n_process=n_process)
+
+
 class NamedEntityRecognizer(BaseEstimator, TransformerMixin):
     def __init__(self, spacy_model, disable=None, min_entity_counts=None,
-                 max_entities=None):
+                 max_entities=None, batch_size=1000, n_process=1, doc_cache=None):
         self.nlp = spacy_model.load()
         self.disable = disable if disable is not None else []
         self.min_entity_counts = min_entity_counts
         self.max_entities = max_entities
+        self.batch_size = batch_size
+        self.n_process = n_process
+        self.doc_cache = doc_cache
     
     def fit(self, X, y=None):
         return self
 
     def transform(self, X, *args, **kwargs):
-        entities_texts = [self.get_entities(text) for text in X]
-        if self.min_entity_counts is None:
-            return entities_texts
-        
-        return [[entity_label 
-                for entity_label, entity_count in Counter(entities_text).most_common(self.max_entities)
-                if entity_count >= self.min_entity_counts]
-                for entities_text in entities_texts]
+        docs = pipe_docs(self.nlp, X, self.batch_size, self.n_process, self.doc_cache)
+        return [filter_entities(get_doc_entities(doc, self.disable),
+                                self.min_entity_counts, self.max_entities)
+                for doc in tqdm(docs)]
     
     def get_entities(self, text):
-        doc = self.nlp(text)
-        return [x.text for x in doc.ents 
-                if x.label_ not in self.disable
-                and len(x.text) > 2]
+        return get_doc_entities(self.nlp(text), self.disable)
     
     def get_most_common_entities(self, text, n=10):
         entities = self.get_entities(text)
@@ -56,27 +241,134 @@ class NamedEntityRecognizer(BaseEstimator, TransformerMixin):
 
 
 class TextPreprocessor(BaseEstimator, TransformerMixin):
-    def __init__(self, spacy_model, additional_stopwords=None, disable=None):
+    """ Transform texts into lists of lemmas with spaCy.
+
+    Parameters
+    ----------
+    spacy_model
+        spaCy model package (e.g. `en_core_web_sm`).
+    additional_stopwords : list of str (default=None)
+        Words ignored besides the stop words of the model. They are
+        compared with the lowercased text of each token.
+    disable : list of str (default=None)
+        Components of the spaCy pipeline that are not loaded.
+    batch_size : int (default=1000)
+        Number of texts processed together by spaCy.
+    n_process : int (default=1)
+        Number of processes used by spaCy. -1 uses every available CPU.
+    stream : bool (default=False)
+        If True, `transform` returns a generator that yields the tokens of
+        each text as they are produced, instead of a list, so a large corpus
+        can be fed directly to a vectorizer.
+    doc_cache : :obj:`DocCache` (default=None)
+        Cache used to avoid parsing texts that were already processed.
+    """
+
+    def __init__(self, spacy_model, additional_stopwords=None, disable=None,
+                 batch_size=1000, n_process=1, stream=False, doc_cache=None):
         self.disable = disable if disable is not None else []
         self.custom_stop_words = additional_stopwords if additional_stopwords is not None else []
+        self.batch_size = batch_size
+        self.n_process = n_process
+        self.stream = stream
+        self.doc_cache = doc_cache
         self.nlp = spacy_model.load(disable=self.disable)
+        self._stop_words = frozenset(word.lower() for word in self.custom_stop_words)
 
     def fit(self, X, y=None):
         return self
 
     def transform(self, X, *args, **kwargs):
+        if self.stream:
+            return self.iter_transform(X)
         return self._preprocess_docs(X)
-    
+
+    def iter_transform(self, X):
+        """ Yield the list of tokens of each text as soon as it is processed. """
+        docs = pipe_docs(self.nlp, X, self.batch_size, self.n_process, self.doc_cache)
+        for doc in tqdm(docs):
+            yield self._get_doc_tokens(doc)
+
     def _preprocess_docs(self, X):
-        preproc_pipe = []
-        for doc in tqdm(self.nlp.pipe(X)):
-            preproc_pipe.append(self._get_doc_tokens(doc))
-        return preproc_pipe
+        return list(self.iter_transform(X))
     
     def _get_doc_tokens(self, doc):
-        return [t.lemma_ for t in doc if len(t.text) > 2 and
-                not self._is_stop_word(t) and t.text not in string.punctuation
-                and t.is_alpha and not t.is_digit]
+        return get_doc_tokens(doc, self._stop_words)
+
+
+class TextAnnotator(BaseEstimator, TransformerMixin):
+    """ Get both the tokens and the named entities of texts parsing them only once.
+
+    Using a :obj:`TextPreprocessor` and a :obj:`NamedEntityRecognizer` on the
+    same corpus loads two models and parses every text twice. This class runs
+    a single `nlp.pipe` and derives the lemmas and the entities of each text
+    from the same spaCy Doc, with the same filters as those classes.
+
+    Parameters
+    ----------
+    spacy_model
+        spaCy model package (e.g. `en_core_web_sm`).
+    additional_stopwords : list of str (default=None)
+        Words ignored besides the stop words of the model.
+    disabled_entity_labels : list of str (default=None)
+        Labels of the entities that are ignored.
+    min_entity_counts : int (default=None)
+        Minimum number of times an entity must appear in a text to be kept.
+        If None, every entity is kept.
+    max_entities : int (default=None)
+        Maximum number of entities kept for each text when `min_entity_counts`
+        is used.
+    disable : list of str (default=ANNOTATOR_DISABLED_COMPONENTS)
+        Components of the spaCy pipeline that are not loaded. By default, only
+        the dependency parser, which is not needed for lemmas and entities.
+    batch_size : int (default=1000)
+        Number of texts processed together by spaCy.
+    n_process : int (default=1)
+        Number of processes used by spaCy. -1 uses every available CPU.
+    doc_cache : :obj:`DocCache` (default=None)
+        Cache used to avoid parsing texts that were already processed.
+    """
+
+    def __init__(self, spacy_model, additional_stopwords=None, disabled_entity_labels=None,
+                 min_entity_counts=None, max_entities=None, disable=None,
+                 batch_size=1000, n_process=1, doc_cache=None):
+        self.additional_stopwords = additional_stopwords
+        self.disabled_entity_labels = disabled_entity_labels
+        self.min_entity_counts = min_entity_counts
+        self.max_entities = max_entities
+        self.disable = disable if disable is not None else ANNOTATOR_DISABLED_COMPONENTS
+        self.batch_size = batch_size
+        self.n_process = n_process
+        self.doc_cache = doc_cache
+        self.nlp = spacy_model.load(disable=self.disable)
+        self._stop_words = frozenset(word.lower() for word in additional_stopwords or [])
+        self._disabled_entity_labels = frozenset(disabled_entity_labels or [])
+
+    def fit(self, X, y=None):
+        return self
+
+    def transform(self, X, *args, **kwargs):
+        """ Get the tokens and the entities of each text.
+
+        Returns
+        -------
+        (list of list of str, list of list of str)
+            Tuple with the lemmas of each text and the entities of each text.
+        """
+        tokens_texts, entities_texts = [], []
+        for tokens, entities in self.iter_transform(X):
+            tokens_texts.append(tokens)
+            entities_texts.append(entities)
+        return tokens_texts, entities_texts
+
+    def iter_transform(self, X):
+        """ Yield a tuple with the tokens and the entities of each text as soon
+        as it is processed. """
+        docs = pipe_docs(self.nlp, X, self.batch_size, self.n_process, self.doc_cache)
+        for doc in tqdm(docs):
+            yield self._annotate(doc)
 
-    def _is_stop_word(self, token):
-        return token.is_stop or token.text.lower() in self.custom_stop_words
+    def _annotate(self, doc):
+        entities = filter_entities(get_doc_entities(doc, self._disabled_entity_labels),
+                                   self.min_entity_counts, self.max_entities)
+        return get_doc_tokens(doc, self._stop_words), entities
@@ -1,15 +1,28 @@
-import multiprocessing.dummy as mp
-import networkx.algorithms as nxa
 import numpy as np
 
-from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass
 
 from joblib import Parallel, delayed
 from sklearn.base import TransformerMixin, BaseEstimator
 from tqdm.notebook import tqdm
 
+from .centrality import information_centrality
+from .concurrency import AsyncioExecutor, iter_results
 from .graph import get_centrality_algorithm_results, get_largest_connected_subgraph
+from .utils import top_k_indices
+
+
+_worker_labeller = None
+
+
+def _init_labeller_worker(labeller):
+    global _worker_labeller
+    _worker_labeller = labeller
+
+
+def _get_worker_topic_labels(linked_entities):
+    return _worker_labeller.get_topic_labels(linked_entities)
 
 
 @dataclass
@@ -27,7 +40,7 @@ class Topic():
                      n['uris'], score, t_type)
 
     def __eq__(self, other):
-        if not isinstance(other, Topic):
+        if not isinstance(other, (Topic, ScoredTopic)):
             return False
         return self.qid == other.qid
 
@@ -41,6 +54,62 @@ class Topic():
         return f"{self.labels['en']} ({self.qid})"
 
 
+class ScoredTopic():
+    """ Score obtained by a shared :obj:`Topic` for a given text.
+
+    It exposes the same fields as the topic it references, except for
+    its own score, so it can be used wherever a :obj:`Topic` is expected
+    without copying the labels, descriptions and uris of the topic.
+
+    Parameters
+    ----------
+    topic : :obj:`Topic`
+        Topic being scored.
+    score : float
+        Score of the topic for the text.
+    """
+
+    __slots__ = ('topic', 'score')
+
+    def __init__(self, topic, score):
+        self.topic = topic
+        self.score = score
+
+    @property
+    def labels(self):
+        return self.topic.labels
+
+    @property
+    def qid(self):
+        return self.topic.qid
+
+    @property
+    def descs(self):
+        return self.topic.descs
+
+    @property
+    def uris(self):
+        return self.topic.uris
+
+    @property
+    def t_type(self):
+        return self.topic.t_type
+
+    def __eq__(self, other):
+        if not isinstance(other, (Topic, ScoredTopic)):
+            return False
+        return self.qid == other.qid
+
+    def __hash__(self):
+        return hash(self.qid)
+
+    def __str__(self):
+        return str(self.topic)
+
+    def __repr__(self):
+        return repr(self.topic)
+
+
 class LabelledTopicModel(BaseEstimator, TransformerMixin):
     """
 
@@ -53,7 +122,8 @@ class LabelledTopicModel(BaseEstimator, TransformerMixin):
         List with the topics to be asigned to each one of the topics
         of the model.
     num_topics_returned : int
-        Number of topics to be assigned to each text.
+        Number of topics to be assigned to each text. Each one is returned
+        as a :obj:`ScoredTopic` referencing the shared topic of the model.
     """
 
     def __init__(self, topic_model, topics, num_topics_returned=3):
@@ -67,17 +137,13 @@ class LabelledTopicModel(BaseEstimator, TransformerMixin):
 
     def transform(self, X, *args, **kwargs):
         topic_distr = self.topic_model.transform(X)
-        best_topics_idx = [np.argsort(text_topics)[::-1]
-                           for text_topics in topic_distr]
-        res = []
-        for text_idx, text_topics in enumerate(best_topics_idx):
-            text_res = []
-            for topic_idx in text_topics[:self.num_topics_returned]:
-                new_topic = deepcopy(self.topics[topic_idx])
-                new_topic.score = topic_distr[text_idx][topic_idx]
-                text_res.append(new_topic)
-            res.append(text_res)
-        return res
+        best_topics_idx = top_k_indices(topic_distr, self.num_topics_returned)
+        best_scores = np.take_along_axis(topic_distr, best_topics_idx, axis=1)
+        topics = self.topics
+        return [[ScoredTopic(topics[topic_idx], score)
+                 for topic_idx, score in zip(text_topics, text_scores)]
+                for text_topics, text_scores in zip(best_topics_idx.tolist(),
+                                                    best_scores.tolist())]
 
 
 class TopicCombiner(BaseEstimator, TransformerMixin):
@@ -104,7 +170,7 @@ class TopicCombiner(BaseEstimator, TransformerMixin):
                             if topic.t_type =='ner'
                             else topic.score * self.k
                             for topic in doc_topics]
-            best_topics_idx = np.argsort(topic_scores)[::-1][:self.max_num_topics]
+            best_topics_idx = top_k_indices(topic_scores, self.max_num_topics)
             res.append([(doc_topics[idx], topic_scores[idx])
                         for idx in best_topics_idx])
         return res
@@ -120,34 +186,88 @@ class TopicLabeller(BaseEstimator, TransformerMixin):
         of each seed term.
     r : callable
         Function used to select the node that best represents the
-        contents of the generated graph.
+        contents of the generated graph. By default, information centrality
+        is computed with :func:`herc_common.centrality.information_centrality`.
     num_labels_per_topic : int
         Number of nodes to return as labels from the graph.
-    stop_uris : list of str
-        List of stop uris to be discarded when returning the
-        final list of nodes.
+    stop_uris : iterable of str
+        Stop uris to be discarded when returning the final list of nodes.
+    executor : str (default='thread')
+        How documents are labelled concurrently. 'thread' uses a pool of
+        threads, 'process' a pool of processes (each one with its own copy
+        of the labeller), and 'async' builds the graphs of several documents
+        at the same time in a single event loop.
+    n_workers : int (default=8)
+        Number of workers of the executor. With 'async', it is the number
+        of documents labelled at the same time.
     """
 
     def __init__(self, graph_builder,
-                 r=nxa.centrality.information_centrality,
+                 r=information_centrality,
                  num_labels_per_topic=1,
-                 stop_uris=None):
+                 stop_uris=None,
+                 executor='thread',
+                 n_workers=8):
+        if executor not in ('thread', 'process', 'async'):
+            raise ValueError(f"Unknown executor: {executor}")
         self.graph_builder = graph_builder
         self.r = r
         self.num_labels = num_labels_per_topic
-        self.stop_uris = [] if stop_uris is None else stop_uris
+        self.stop_uris = frozenset() if stop_uris is None else frozenset(stop_uris)
+        self.executor = executor
+        self.n_workers = n_workers
 
     def fit(self, X, y=None):
         return self
 
     def transform(self, X, *args, **kwargs):
-        pool = mp.Pool()
-        results = pool.map(self.get_topic_labels, X)
-        return results
+        return [labels for _, labels in self.iter_transform(X)]
+
+    def iter_transform(self, X, ordered=True):
+        """ Label each document, yielding its labels as soon as they are ready.
+
+        At most twice `n_workers` documents are being processed or waiting
+        to be consumed at any time.
+
+        Parameters
+        ----------
+        X : iterable of list of (str, str)
+            Linked entities of each document.
+        ordered : bool (default=True)
+            If True, labels are yielded in the same order as the documents.
+            Otherwise, they are yielded in the order they are completed.
+
+        Yields
+        ------
+        (int, list of :obj:`Topic`)
+            Tuple where the first element is the index of the document and
+            the second one its labels.
+        """
+        if self.executor == 'thread':
+            executor = ThreadPoolExecutor(max_workers=self.n_workers)
+            fn = self.get_topic_labels
+        elif self.executor == 'process':
+            executor = ProcessPoolExecutor(max_workers=self.n_workers,
+                                           initializer=_init_labeller_worker,
+                                           initargs=(self,))
+            fn = _get_worker_topic_labels
+        else:
+            executor = AsyncioExecutor()
+            fn = self.aget_topic_labels
+
+        with executor:
+            yield from iter_results(executor, fn, X, 2 * self.n_workers, ordered)
 
     def get_topic_labels(self, linked_entities):
         topic_neighbourhood = self.graph_builder.build_graph(linked_entities)
-        subgraph = get_largest_connected_subgraph(topic_neighbourhood)
+        return self._get_graph_labels(topic_neighbourhood)
+
+    async def aget_topic_labels(self, linked_entities):
+        topic_neighbourhood = await self.graph_builder.abuild_graph(linked_entities)
+        return self._get_graph_labels(topic_neighbourhood)
+
+    def _get_graph_labels(self, topic_neighbourhood):
+        subgraph = get_largest_connected_subgraph(topic_neighbourhood, copy=False)
         best_nodes = get_centrality_algorithm_results(subgraph, self.r,
             self.stop_uris, self.num_labels)
         return [Topic.from_node(n, score, "ner") for n, score in best_nodes]
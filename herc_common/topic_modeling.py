@@ -1,23 +1,331 @@
+import logging
+import os
+import shutil
+import tempfile
+
 import numpy as np
+import scipy.sparse as sp
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
 
 from tmtoolkit.topicmod.evaluate import metric_coherence_gensim
 
+from .concurrency import iter_results
+from .utils import VocabularyIndex, get_vocabulary_index
+
+
+logger = logging.getLogger(__name__)
+
+_sweep_worker_state = {}
+
+COHERENCE_EPSILON = 1e-12
+COHERENCE_WINDOW_SIZES = {
+    'c_uci': 10,
+    'c_npmi': 10,
+    'u_mass': None
+}
+
 
 def base_scoring_function(vectorizer, texts, model, X, top_n=10, measure='u_mass'):
     return metric_coherence_gensim(measure=measure, dtm=X, 
                                    topic_word_distrib=model.components_,
-                                   vocab=np.array([x for x in vectorizer.vocabulary_.keys()]), 
+                                   vocab=get_vocabulary_index(vectorizer).terms, 
                                    texts=texts, return_mean=True, top_n=top_n)
 
+class CoherenceScorer():
+    """ Compute the coherence of topic models from precomputed word statistics.
+
+    The document frequency of each word (u_mass), or the number of sliding
+    windows of the texts where it appears (c_uci, c_npmi), is stored once as
+    a sparse boolean matrix. Co-occurrence counts of the top words of a model
+    are then obtained with a single sparse matrix product, instead of going
+    over the whole corpus again for each model. Results are the same as the
+    ones returned by gensim (and :func:`base_scoring_function`).
+
+    Instances can be used as the scoring function of :func:`compute_model_results`.
+
+    Parameters
+    ----------
+    vocab : array-like of str or :obj:`VocabularyIndex`
+        Vocabulary of the models, aligned with the columns of X.
+    X : sparse matrix (default=None)
+        Document-term matrix. Required for 'u_mass'.
+    texts : list of list of str (default=None)
+        Tokens of each document. Required for 'c_uci' and 'c_npmi'.
+    measure : str (default='u_mass')
+        Coherence measure. One of 'u_mass', 'c_uci' or 'c_npmi'.
+    top_n : int (default=10)
+        Number of top words of each topic used to compute its coherence.
+    window_size : int (default=None)
+        Size of the sliding windows. If None, the default of gensim for
+        the measure is used.
+    """
+
+    def __init__(self, vocab, X=None, texts=None, measure='u_mass', top_n=10,
+                 window_size=None):
+        if measure not in COHERENCE_WINDOW_SIZES:
+            raise ValueError(f"Unsupported coherence measure: {measure}")
+        self.vocab = vocab.terms if isinstance(vocab, VocabularyIndex) else np.asarray(vocab)
+        self.measure = measure
+        self.top_n = top_n
+        self.window_size = window_size or COHERENCE_WINDOW_SIZES[measure]
+        if measure == 'u_mass':
+            if X is None:
+                raise ValueError("X must be given for the 'u_mass' measure")
+            self.occurrences = sp.csc_matrix(X, dtype=bool)
+        else:
+            if texts is None:
+                raise ValueError(f"texts must be given for the '{measure}' measure")
+            self.occurrences = self._get_window_occurrences(texts)
+        self.num_docs = self.occurrences.shape[0]
+
+    def __call__(self, model, X=None):
+        return self.get_coherence(model.components_)
+
+    def get_coherence(self, topic_word_distrib, return_mean=True):
+        """ Compute the coherence of each topic of a topic-word distribution.
+
+        Returns
+        -------
+        float or :obj:`numpy.ndarray`
+            Mean coherence of the topics if `return_mean` is True. Otherwise,
+            the coherence of each topic.
+        """
+        topic_word_distrib = np.asarray(topic_word_distrib)
+        top_words = np.argsort(topic_word_distrib, axis=1)[:, :-self.top_n - 1:-1]
+        word_ids, top_idx = np.unique(top_words, return_inverse=True)
+        top_idx = top_idx.reshape(top_words.shape)
+
+        word_occurrences = self.occurrences[:, word_ids].astype(np.float64)
+        counts = np.asarray(word_occurrences.sum(axis=0)).ravel()
+        co_counts = (word_occurrences.T @ word_occurrences).toarray()
+
+        n = top_idx.shape[1]
+        if self.measure == 'u_mass':
+            # pairs (w_i, w_j) with j < i, as in the s_one_pre segmentation
+            first, second = np.tril_indices(n, -1)
+        else:
+            # every ordered pair of different words (s_one_one)
+            first, second = np.nonzero(~np.eye(n, dtype=bool))
+        w_prime = top_idx[:, first]
+        w_star = top_idx[:, second]
+        co_prob = co_counts[w_prime, w_star] / self.num_docs + COHERENCE_EPSILON
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if self.measure == 'u_mass':
+                star_prob = counts[w_star] / self.num_docs
+                sims = np.where(star_prob > 0, np.log(co_prob / star_prob), 0.0)
+            else:
+                sims = np.log(co_prob / ((counts[w_prime] / self.num_docs) *
+                                         (counts[w_star] / self.num_docs)))
+                if self.measure == 'c_npmi':
+                    sims = sims / -np.log(co_prob)
+        topic_coherences = sims.mean(axis=1)
+        return topic_coherences.mean() if return_mean else topic_coherences
+
+    def _get_window_occurrences(self, texts):
+        # gensim does not check each window, but slides them: when moving to
+        # the next window, the token leaving it is marked as absent (even if it
+        # appears again inside the window) and the one entering it as present.
+        # The same add/remove events are replayed here to obtain its counts.
+        word_ids = {word: idx for idx, word in enumerate(self.vocab)}
+        lengths = np.array([len(text) for text in texts], dtype=np.int64)
+        ids = np.fromiter((word_ids.get(token, -1) for text in texts for token in text),
+                          dtype=np.int64, count=lengths.sum())
+        # texts shorter than the window are a single window
+        text_windows = np.maximum(1, lengths - self.window_size + 1)
+        window_offsets = np.concatenate([[0], np.cumsum(text_windows)[:-1]])
+        token_offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+
+        in_vocab = np.nonzero(ids >= 0)[0]
+        token_text = np.repeat(np.arange(len(lengths)), lengths)[in_vocab]
+        token_word = ids[in_vocab]
+        positions = in_vocab - token_offsets[token_text]
+        add_steps = np.maximum(0, positions - self.window_size + 1)
+        removed = positions + 1 < text_windows[token_text]
+
+        event_text = np.concatenate([token_text, token_text[removed]])
+        event_word = np.concatenate([token_word, token_word[removed]])
+        event_step = np.concatenate([add_steps, positions[removed] + 1])
+        event_is_add = np.concatenate([np.ones(len(add_steps), dtype=bool),
+                                       np.zeros(removed.sum(), dtype=bool)])
+        # removals of a step are applied before additions
+        order = np.lexsort((event_is_add, event_step, event_word, event_text))
+        event_text = event_text[order]
+        event_word = event_word[order]
+        event_step = event_step[order]
+        event_is_add = event_is_add[order]
+
+        # a word is present from each addition until its next event
+        same_word_next = np.zeros(len(order), dtype=bool)
+        same_word_next[:-1] = (event_text[1:] == event_text[:-1]) & \
+            (event_word[1:] == event_word[:-1])
+        next_step = text_windows[event_text]
+        next_step[:-1] = np.where(same_word_next[:-1], event_step[1:], next_step[:-1])
+        spans = np.where(event_is_add, next_step - event_step, 0)
+
+        span_starts = np.repeat(window_offsets[event_text] + event_step, spans)
+        span_offsets = np.arange(spans.sum()) - np.repeat(np.cumsum(spans) - spans, spans)
+        rows = span_starts + span_offsets
+        cols = np.repeat(event_word, spans)
+        return sp.csc_matrix((np.ones(len(rows), dtype=bool), (rows, cols)),
+                             shape=(int(text_windows.sum()), len(self.vocab)))
+
+
 def compute_model_results(model_cls, X, scoring_func, min_topics=7,
-                          max_topics=30, seed=42, **kwargs):
-    res = {}
-    for num_topics in range(min_topics, max_topics):
-        model = model_cls(n_components=num_topics, random_state=seed, **kwargs)
-        model.fit(X)
-        score = scoring_func(model, X)
-        res[model] = score
-    return res
+                          max_topics=30, seed=42, n_workers=1, patience=None,
+                          **kwargs):
+    """ Fit and score a model for each number of topics in the given range.
+
+    See :func:`iter_model_results` for a description of the parameters.
+
+    Returns
+    -------
+    dict of (model, float)
+        Dictionary with the score of each fitted model, sorted by their
+        number of topics.
+    """
+    results = sorted(iter_model_results(model_cls, X, scoring_func, min_topics,
+                                        max_topics, seed, n_workers, patience,
+                                        **kwargs),
+                     key=lambda result: result[0])
+    return {model: score for _, model, score in results}
+
+
+def iter_model_results(model_cls, X, scoring_func, min_topics=7,
+                       max_topics=30, seed=42, n_workers=1, patience=None,
+                       **kwargs):
+    """ Fit and score a model for each number of topics, yielding them as they finish.
+
+    With more than one worker, models are fitted and scored in a pool of
+    processes. The document-term matrix is saved once to a temporary folder
+    and memory-mapped by each worker instead of being pickled to them. The
+    scoring function is sent once to each worker; with the 'fork' start method
+    (the default on Linux) it can be any callable, otherwise it must be picklable.
+
+    Parameters
+    ----------
+    model_cls
+        Sklearn topic model class with `n_components` and `random_state` params.
+    X
+        Document-term matrix used to fit the models.
+    scoring_func : callable
+        Function receiving a fitted model and X, and returning its score.
+        Higher scores are considered better.
+    min_topics : int (default=7)
+        Minimum number of topics of the models.
+    max_topics : int (default=30)
+        Maximum number of topics of the models (exclusive).
+    seed : int (default=42)
+        Random state of the models.
+    n_workers : int (default=1)
+        Number of processes used to fit the models. If 1, models are fitted
+        one after another in the current process.
+    patience : int (default=None)
+        If given, the sweep stops once the best score has not improved for
+        this many consecutive numbers of topics. Models still being fitted
+        at that point are discarded.
+    **kwargs
+        Additional params passed to the constructor of the models.
+
+    Yields
+    ------
+    (int, model, float)
+        Tuple with the number of topics, the fitted model and its score.
+    """
+    scores = {}
+    next_num_topics = min_topics
+    best_score = None
+    num_not_improved = 0
+    results = _iter_fitted_models(model_cls, X, scoring_func, min_topics,
+                                  max_topics, seed, n_workers, kwargs)
+    with closing(results):
+        for num_topics, model, score in results:
+            yield num_topics, model, score
+            if patience is None:
+                continue
+
+            # results may arrive in any order, but improvements are
+            # measured following the number of topics
+            scores[num_topics] = score
+            while next_num_topics in scores:
+                curr_score = scores.pop(next_num_topics)
+                if best_score is None or curr_score > best_score:
+                    best_score = curr_score
+                    num_not_improved = 0
+                else:
+                    num_not_improved += 1
+                next_num_topics += 1
+            if num_not_improved >= patience:
+                logger.info("Score has not improved in %d models. Stopping at %d topics.",
+                            patience, next_num_topics - 1)
+                return
+
+
+def _iter_fitted_models(model_cls, X, scoring_func, min_topics, max_topics,
+                        seed, n_workers, kwargs):
+    topic_range = range(min_topics, max_topics)
+    if n_workers == 1:
+        for num_topics in topic_range:
+            model, score = _fit_and_score(model_cls, X, scoring_func,
+                                          num_topics, seed, kwargs)
+            yield num_topics, model, score
+        return
+
+    folder = tempfile.mkdtemp(prefix='herc_sweep_')
+    try:
+        X_handle = _save_shared_matrix(X, folder)
+        executor = ProcessPoolExecutor(max_workers=n_workers,
+                                       initializer=_init_sweep_worker,
+                                       initargs=(model_cls, X_handle, scoring_func,
+                                                 seed, kwargs))
+        results = iter_results(executor, _fit_and_score_in_worker, topic_range,
+                               n_workers, ordered=False)
+        with executor, closing(results):
+            for idx, (model, score) in results:
+                yield topic_range[idx], model, score
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def _fit_and_score(model_cls, X, scoring_func, num_topics, seed, kwargs):
+    model = model_cls(n_components=num_topics, random_state=seed, **kwargs)
+    model.fit(X)
+    return model, scoring_func(model, X)
+
+
+def _init_sweep_worker(model_cls, X_handle, scoring_func, seed, kwargs):
+    _sweep_worker_state.update(model_cls=model_cls, X=_load_shared_matrix(X_handle),
+                               scoring_func=scoring_func, seed=seed, kwargs=kwargs)
+
+
+def _fit_and_score_in_worker(num_topics):
+    state = _sweep_worker_state
+    return _fit_and_score(state['model_cls'], state['X'], state['scoring_func'],
+                          num_topics, state['seed'], state['kwargs'])
+
+
+def _save_shared_matrix(X, folder):
+    if sp.issparse(X):
+        X = X.tocsr()
+        arrays = {'data': X.data, 'indices': X.indices, 'indptr': X.indptr}
+    else:
+        arrays = {'X': np.asarray(X)}
+    for name, arr in arrays.items():
+        np.save(os.path.join(folder, f"{name}.npy"), arr)
+    return folder, sp.issparse(X), X.shape
+
+
+def _load_shared_matrix(X_handle):
+    folder, is_sparse, shape = X_handle
+
+    def load(name):
+        return np.load(os.path.join(folder, f"{name}.npy"), mmap_mode='r')
+
+    if is_sparse:
+        return sp.csr_matrix((load('data'), load('indices'), load('indptr')),
+                             shape=shape, copy=False)
+    return load('X')
 
 def get_best_model(model_results):
     return max(model_results, key=model_results.get)
@@ -28,9 +336,12 @@ def print_results_info(model_results):
     print(f"Topic coherence: {model_results[best_model]}")
 
 def print_top_words(model, feature_names, n_top_words):
-    for topic_idx, topic in enumerate(model.components_):
+    if not isinstance(feature_names, VocabularyIndex):
+        feature_names = VocabularyIndex(feature_names)
+    top_words = feature_names.get_terms(
+        model.components_.argsort(axis=1)[:, :-n_top_words - 1:-1])
+    for topic_idx, words in enumerate(top_words):
         message = "Topic #%d: " % topic_idx
-        message += " ".join([feature_names[i]
-                             for i in topic.argsort()[:-n_top_words - 1:-1]])
+        message += " ".join(words)
         print(message)
     print()
@@ -1,4 +1,12 @@
 import functools
+import gzip
+import heapq
+import json
+import os
+import pickle as std_pickle
+import shutil
+import tempfile
+import weakref
 
 import dill as pickle
 import numpy as np
@@ -11,25 +19,144 @@ ITSRDF = Namespace("http://www.w3.org/2005/11/its/rdf#")
 NIF = Namespace("https://persistence.uni-leipzig.org/nlp2rdf/ontologies/nif-core#")
 WIKIDATA_BASE = "https://www.wikidata.org/w"
 
-def add_text_topics_to_graph(uri, c_id, text, topics, g):
-    context_element = URIRef(f"{EDMA}{c_id}")
+ARTIFACT_FORMAT = 'herc_common.artifact'
+ARTIFACT_VERSION = 1
+ARTIFACT_MANIFEST = 'manifest.json'
+ARTIFACT_MIN_ARRAY_BYTES = 1024
+
+_vocabulary_indexes = weakref.WeakKeyDictionary()
+
+def add_text_topics_to_graph(uri, c_id, text, topics, g, topic_terms=None):
+    for triple in get_text_topics_triples(uri, c_id, text, topics, topic_terms):
+        g.add(triple)
+    return get_context_element(c_id)
+
+def get_context_element(c_id):
+    return URIRef(f"{EDMA}{c_id}")
+
+def get_topic_terms(topic):
+    """ Get the (predicate, object) pairs with the labels, descriptions
+    and URIs of a topic. """
+    return tuple([(RDFS.label, Literal(val, lang=lang)) for lang, val in topic.labels.items()] +
+                 [(RDFS.comment, Literal(val, lang=lang)) for lang, val in topic.descs.items()] +
+                 [(ITSRDF.taIdentRef, URIRef(uri)) for uri in topic.uris])
+
+def get_text_topics_triples(uri, c_id, text, topics, topic_terms=None):
+    """ Yield the NIF triples of a text and its topics, as added by
+    :func:`add_text_topics_to_graph`.
+
+    `topic_terms` is a dict where the terms of each topic are kept by QID,
+    so they are built only once when it is shared between texts.
+    """
+    if topic_terms is None:
+        topic_terms = {}
+    context_element = get_context_element(c_id)
     text_element = Literal(text)
-    g.add((context_element, NIF.isString, text_element))
-    g.add((context_element, NIF.sourceURL, URIRef(uri)))
-    g.add((context_element, NIF.predominantLanguage, Literal('en')))
+    yield (context_element, NIF.isString, text_element)
+    yield (context_element, NIF.sourceURL, URIRef(uri))
+    yield (context_element, NIF.predominantLanguage, Literal('en'))
     for topic, score in topics:
-        topic_label = '_'.join(str(topic).split(' '))
+        terms = topic_terms.get(topic.qid)
+        if terms is None:
+            terms = topic_terms[topic.qid] = get_topic_terms(topic)
         topic_element = BNode()
-        g.add((topic_element, RDF.type, NIF.annotation))
-        g.add((topic_element, NIF.confidence, Literal(topic.score)))
-        for lang, val in topic.labels.items():
-            g.add((topic_element, RDFS.label, Literal(val, lang=lang)))
-        for lang, val in topic.descs.items():
-            g.add((topic_element, RDFS.comment, Literal(val, lang=lang)))
-        for uri in topic.uris:
-            g.add((topic_element, ITSRDF.taIdentRef, URIRef(uri)))
-        g.add((context_element, NIF.topic, topic_element))
-    return context_element
+        yield (topic_element, RDF.type, NIF.annotation)
+        yield (topic_element, NIF.confidence, Literal(topic.score))
+        for predicate, obj in terms:
+            yield (topic_element, predicate, obj)
+        yield (context_element, NIF.topic, topic_element)
+
+class TextTopicsWriter():
+    """ Write the NIF triples of texts and their topics straight to a file.
+
+    This writes the same triples as :func:`add_text_topics_to_graph`, but
+    each text is written as soon as it is added instead of being kept in
+    an in-memory graph, so memory does not grow with the corpus. The
+    serialized labels, descriptions and URIs of each topic are kept by QID,
+    so they are built only once per export.
+
+    Parameters
+    ----------
+    path : str
+        Path of the output file. If it ends with '.gz', it is gzip-compressed.
+    graph_name : str (default=None)
+        IRI of the graph of the triples. If given, the file is written in
+        N-Quads format. Otherwise, in N-Triples.
+    compress : bool (default=None)
+        Whether to gzip the file. If None, it depends on the extension of `path`.
+    """
+
+    def __init__(self, path, graph_name=None, compress=None):
+        if compress is None:
+            compress = path.endswith('.gz')
+        self.path = path
+        self.graph_name = graph_name
+        self._end = f" {_nt_term(URIRef(graph_name))} .\n" if graph_name is not None else " .\n"
+        self._topic_terms = {}
+        if compress:
+            self._file = gzip.open(path, 'wt', encoding='utf-8')
+        else:
+            self._file = open(path, 'w', encoding='utf-8')
+
+    def add_text_topics(self, uri, c_id, text, topics):
+        """ Write the triples of a text and its topics.
+
+        Returns
+        -------
+        :obj:`rdflib.URIRef`
+            Node of the text.
+        """
+        end = self._end
+        context_element = get_context_element(c_id)
+        context = _nt_term(context_element)
+        lines = [f"{context} {_NT_IS_STRING} {_nt_term(Literal(text))}{end}",
+                 f"{context} {_NT_SOURCE_URL} {_nt_term(URIRef(uri))}{end}",
+                 f"{context} {_NT_PREDOMINANT_LANGUAGE} {_NT_EN}{end}"]
+        for topic, score in topics:
+            terms = self._topic_terms.get(topic.qid)
+            if terms is None:
+                terms = self._topic_terms[topic.qid] = [
+                    f"{_nt_term(predicate)} {_nt_term(obj)}"
+                    for predicate, obj in get_topic_terms(topic)]
+            topic_element = _nt_term(BNode())
+            lines.append(f"{topic_element} {_NT_TYPE} {_NT_ANNOTATION}{end}")
+            lines.append(f"{topic_element} {_NT_CONFIDENCE} {_nt_term(Literal(topic.score))}{end}")
+            lines.extend(f"{topic_element} {term}{end}" for term in terms)
+            lines.append(f"{context} {_NT_TOPIC} {topic_element}{end}")
+        self._file.write(''.join(lines))
+        return context_element
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+def _nt_term(term):
+    if isinstance(term, URIRef):
+        return f"<{term}>"
+    if isinstance(term, BNode):
+        return f"_:{term}"
+    value = '"' + str(term).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n').replace('\r', '\\r') + '"'
+    if term.language:
+        return f"{value}@{term.language}"
+    if term.datatype:
+        return f"{value}^^<{term.datatype}>"
+    return value
+
+_NT_IS_STRING = _nt_term(NIF.isString)
+_NT_SOURCE_URL = _nt_term(NIF.sourceURL)
+_NT_PREDOMINANT_LANGUAGE = _nt_term(NIF.predominantLanguage)
+_NT_EN = _nt_term(Literal('en'))
+_NT_TYPE = _nt_term(RDF.type)
+_NT_ANNOTATION = _nt_term(NIF.annotation)
+_NT_CONFIDENCE = _nt_term(NIF.confidence)
+_NT_TOPIC = _nt_term(NIF.topic)
 
 def empty_if_keyerror(function):
     """
@@ -45,11 +172,192 @@ def empty_if_keyerror(function):
     return wrapper
 
 
+def top_k_keys(scores, k, exclude=frozenset()):
+    """ Return the keys of the k highest values of a dict.
+
+    Parameters
+    ----------
+    scores : dict
+        Dictionary with the score of each key.
+    k : int
+        Number of keys to be returned.
+    exclude : set (default=frozenset())
+        Keys that will not be returned.
+
+    Returns
+    -------
+    list
+        Keys sorted by their score in descending order. Keys with the same
+        score keep the order they have in the dictionary.
+    """
+    return heapq.nlargest(k, (key for key in scores if key not in exclude),
+                          key=scores.get)
+
+
+def top_k_indices(values, k):
+    """ Return the indices of the k highest values along the last axis of an array.
+
+    Only the k highest values are sorted, so this is much faster than
+    a full argsort when k is small compared to the size of the array.
+    Ties are broken by the highest index first, as with
+    `np.argsort(values)[::-1]`.
+
+    Parameters
+    ----------
+    values : array-like
+        Array with the values to be ranked.
+    k : int
+        Number of indices to be returned for each row.
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+        Array with the same shape as `values` except for the last axis,
+        of length min(k, values.shape[-1]), with the indices of the highest
+        values in descending order.
+    """
+    values = np.asarray(values)
+    n = values.shape[-1]
+    k = max(0, min(k, n))
+    if k == 0:
+        return np.empty(values.shape[:-1] + (0,), dtype=np.intp)
+    if k < n:
+        kth = -np.partition(-values, k - 1, axis=-1)[..., k - 1:k]
+        selected = values > kth
+        # the values equal to the k-th highest one are taken from the end
+        ties = values == kth
+        ties_after = np.cumsum(ties[..., ::-1], axis=-1)[..., ::-1]
+        num_ties = k - selected.sum(axis=-1, keepdims=True)
+        selected |= ties & (ties_after <= num_ties)
+        idx = np.argpartition(~selected, k - 1, axis=-1)[..., :k]
+    else:
+        idx = np.broadcast_to(np.arange(n), values.shape)
+    order = np.lexsort((-idx, -np.take_along_axis(values, idx, axis=-1)), axis=-1)
+    return np.take_along_axis(idx, order, axis=-1)
+
+
+class VocabularyIndex():
+    """ Vocabulary of a fitted vectorizer, aligned with the columns of its matrices.
+
+    Parameters
+    ----------
+    terms : array-like of str
+        Term of each column of the document-term matrix.
+    """
+
+    def __init__(self, terms):
+        self.terms = np.asarray(terms, dtype=str)
+        self._term_ids = None
+
+    @classmethod
+    def from_vocabulary(cls, vocabulary):
+        """ Build the index from a dict with the column of each term (e.g. `vocabulary_`). """
+        terms = np.empty(len(vocabulary), dtype=object)
+        terms[np.fromiter(vocabulary.values(), dtype=np.intp, count=len(vocabulary))] = \
+            list(vocabulary.keys())
+        return cls(terms)
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __getitem__(self, idx):
+        return self.terms[idx]
+
+    def get_terms(self, indices):
+        """ Return the terms of an array of column indices, with its same shape. """
+        return self.terms[indices]
+
+    def index(self, term):
+        """ Return the column of a term. """
+        if self._term_ids is None:
+            self._term_ids = {term: i for i, term in enumerate(self.terms.tolist())}
+        return self._term_ids[term]
+
+
+def get_vocabulary_index(vectorizer):
+    """ Get the :obj:`VocabularyIndex` of a fitted sklearn vectorizer.
+
+    The index is built once and reused in later calls with the same
+    vectorizer, until it is fitted again.
+    """
+    vocabulary = vectorizer.vocabulary_
+    cached = _vocabulary_indexes.get(vectorizer)
+    if cached is None or cached[0] is not vocabulary:
+        cached = (vocabulary, VocabularyIndex.from_vocabulary(vocabulary))
+        _vocabulary_indexes[vectorizer] = cached
+    return cached[1]
+
+
+class TopicTermRelevance():
+    """ Relevance of the terms of each topic, precomputed for any value of lambda.
+
+    The relevance formula of pyLDAvis is
+    `lambda * log(p(w|t)) + (1 - lambda) * log(p(w|t) / p(w))`, which is the
+    same as `log(p(w|t)) - (1 - lambda) * log(p(w))`. Only the log topic-term
+    distribution and the log term proportions are stored, so the relevance
+    for several values of lambda is obtained with a single broadcasted operation.
+
+    Parameters
+    ----------
+    model
+        Sklearn topic modelling algorithm with a components_ field.
+    vectorizer
+        Sklearn vectorizer already trained.
+    dtm_tf
+        Document term matrix of the initial training corpus returned by the vectorizer.
+    dtype : numpy dtype (default=np.float64)
+        Type of the stored matrices. Using np.float32 halves the memory needed
+        for large vocabularies.
+    """
+
+    def __init__(self, model, vectorizer, dtm_tf, dtype=np.float64):
+        self.vocab = get_vocabulary_index(vectorizer)
+        term_freqs = np.asarray(dtm_tf.sum(axis=0)).ravel()
+        components = np.asarray(model.components_)
+        topic_term_dists = components / components.sum(axis=1)[:, None]
+        self.log_ttd = np.log(topic_term_dists.astype(dtype, copy=False))
+        self.log_term_proportion = np.log((term_freqs / term_freqs.sum()).astype(dtype))
+
+    @property
+    def log_lift(self):
+        return self.log_ttd - self.log_term_proportion
+
+    def get_relevance(self, lambdas):
+        """ Compute the relevance of every term of every topic.
+
+        Parameters
+        ----------
+        lambdas : float or array-like of float
+            Value or values of lambda in the range [0, 1].
+
+        Returns
+        -------
+        :obj:`numpy.ndarray`
+            Array of shape (n_topics, n_terms) if `lambdas` is a float, or
+            (n_lambdas, n_topics, n_terms) otherwise.
+        """
+        lambdas = np.asarray(lambdas, dtype=self.log_ttd.dtype)
+        weights = (lambdas - 1)[..., None, None]
+        return self.log_ttd + weights * self.log_term_proportion
+
+    def get_top_terms(self, top_n, lambdas):
+        """ Get the top n terms of each topic based on relevance.
+
+        Returns
+        -------
+        list of list of str
+            List with the top terms of each topic if `lambdas` is a float,
+            or a list with the top terms of each topic for each value of lambda.
+        """
+        return self.vocab.get_terms(top_k_indices(self.get_relevance(lambdas), top_n)).tolist()
+
+
 def get_topic_terms_by_relevance(model, vectorizer, dtm_tf, top_n, lambda_):
     """ Get the term distribution of a topic based on relevance.
 
     This method uses the relevance formula used by pyLDAvis to customize
-    the relevance of the terms that will be returned.
+    the relevance of the terms that will be returned. To try several values
+    of lambda, use a :obj:`TopicTermRelevance` instead.
 
     Parameters
     ----------
@@ -72,20 +380,13 @@ def get_topic_terms_by_relevance(model, vectorizer, dtm_tf, top_n, lambda_):
         2D array where the first dimension corresponds to each topic of the model, and
         the second one to the top n terms retrieved for each topic.
     """
-    vocab = vectorizer.get_feature_names()
-    term_freqs = dtm_tf.sum(axis=0).getA1()
-    topic_term_dists = model.components_ / model.components_.sum(axis=1)[:, None]
-    term_proportion = term_freqs / term_freqs.sum()
-    log_ttd = np.log(topic_term_dists)
-    log_lift = np.log(topic_term_dists / term_proportion)
-    relevance = lambda_ * log_ttd + (1 - lambda_) * log_lift
-    return [[vectorizer.get_feature_names()[i] for i in topic.argsort()[:-top_n - 1:-1]]
-            for topic in relevance]
+    return TopicTermRelevance(model, vectorizer, dtm_tf).get_top_terms(top_n, lambda_)
 
 
 def load_object(output_path):
-    """
-    """
+    """ Load an object saved with :func:`save_object` or :func:`save_artifact`. """
+    if os.path.isdir(output_path):
+        return load_artifact(output_path)
     # see https://stackoverflow.com/questions/42960637/python-3-5-dill-pickling-unpickling-on-different-servers-keyerror-classtype
     pickle._dill._reverse_typemap['ClassType'] = type
     with open(output_path, 'rb') as file:
@@ -98,3 +399,135 @@ def save_object(obj, output_path):
     """
     with open(output_path, 'wb') as file:
         pickle.dump(obj, file)
+
+
+class _ArrayPersistence():
+    # numpy arrays are written to their own .npy files instead of the pickle
+    def __init__(self, file, arrays_dir):
+        super().__init__(file, protocol=std_pickle.HIGHEST_PROTOCOL)
+        self.arrays_dir = arrays_dir
+        self.arrays = {}
+        # arrays already saved by id, kept alive so their ids are not reused
+        self._saved_arrays = {}
+
+    def persistent_id(self, obj):
+        if type(obj) not in (np.ndarray, np.memmap) or obj.dtype.hasobject or \
+                obj.nbytes < ARTIFACT_MIN_ARRAY_BYTES:
+            return None
+        # the same array referenced several times is stored only once
+        if id(obj) in self._saved_arrays:
+            return self._saved_arrays[id(obj)][0]
+        key = str(len(self.arrays))
+        file_name = f"{key}.npy"
+        np.save(os.path.join(self.arrays_dir, file_name), np.asarray(obj))
+        self.arrays[key] = {'file': file_name, 'dtype': obj.dtype.str,
+                            'shape': list(obj.shape)}
+        self._saved_arrays[id(obj)] = (key, obj)
+        return key
+
+
+class _ArtifactPickler(_ArrayPersistence, pickle.Pickler):
+    # dill is always used, like in save_object: the standard pickler does not fail
+    # for functions and classes defined in __main__, it saves them as references
+    # that cannot be resolved by any other process
+    pass
+
+
+class _ArtifactUnpickler(std_pickle.Unpickler):
+    # the C unpickler also loads the objects pickled by dill, much faster than dill
+    def __init__(self, file, arrays_dir, arrays, mmap_mode):
+        super().__init__(file)
+        self.arrays_dir = arrays_dir
+        self.arrays = arrays
+        self.mmap_mode = mmap_mode
+        self._arrays = {}
+
+    def persistent_load(self, key):
+        if key not in self._arrays:
+            self._arrays[key] = np.load(os.path.join(self.arrays_dir, self.arrays[key]['file']),
+                                        mmap_mode=self.mmap_mode)
+        return self._arrays[key]
+
+
+def _dump_artifact_object(obj, path, arrays_dir, pickler_cls):
+    os.makedirs(arrays_dir)
+    with open(path, 'wb') as file:
+        pickler = pickler_cls(file, arrays_dir)
+        pickler.dump(obj)
+    return pickler.arrays
+
+
+def save_artifact(obj, output_path):
+    """ Save an object as a versioned artifact directory.
+
+    NumPy arrays of the object (e.g. the `components_` of a topic model or
+    the matrices of a sparse matrix) are stored as separate .npy files, so
+    they can be memory-mapped when the artifact is loaded. The rest of the
+    object is pickled with dill, as in :func:`save_object`, and a JSON
+    manifest stores the version of the format and the list of arrays. An
+    existing artifact at `output_path` is replaced.
+
+    Parameters
+    ----------
+    obj
+        Object to be saved.
+    output_path : str
+        Path of the directory of the artifact.
+    """
+    output_path = os.path.abspath(output_path)
+    tmp_path = tempfile.mkdtemp(dir=os.path.dirname(output_path))
+    try:
+        # mkdtemp creates the directory as 0700, give it the usual permissions
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o777 & ~umask)
+        arrays_dir = os.path.join(tmp_path, 'arrays')
+        object_path = os.path.join(tmp_path, 'object.pkl')
+        arrays = _dump_artifact_object(obj, object_path, arrays_dir, _ArtifactPickler)
+        manifest = {
+            'format': ARTIFACT_FORMAT,
+            'version': ARTIFACT_VERSION,
+            'object': 'object.pkl',
+            'arrays_dir': 'arrays',
+            'arrays': arrays,
+            'numpy_version': np.__version__
+        }
+        with open(os.path.join(tmp_path, ARTIFACT_MANIFEST), 'w') as file:
+            json.dump(manifest, file, indent=2)
+        if os.path.isdir(output_path):
+            shutil.rmtree(output_path)
+        os.rename(tmp_path, output_path)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+
+def load_artifact(output_path, mmap_mode='r'):
+    """ Load an object saved with :func:`save_artifact`.
+
+    The artifact is unpickled, so it should only be loaded from trusted sources.
+
+    Parameters
+    ----------
+    output_path : str
+        Path of the directory of the artifact.
+    mmap_mode : str (default='r')
+        Mode used to memory-map the arrays of the object (see :func:`numpy.load`).
+        With 'r', arrays are read-only and their pages are shared by every
+        process that loads the same artifact. If None, arrays are read into memory.
+
+    Returns
+    -------
+    object
+        The saved object.
+    """
+    with open(os.path.join(output_path, ARTIFACT_MANIFEST)) as file:
+        manifest = json.load(file)
+    if manifest.get('format') != ARTIFACT_FORMAT:
+        raise ValueError(f"{output_path} is not a {ARTIFACT_FORMAT} directory")
+    if manifest.get('version', 0) > ARTIFACT_VERSION:
+        raise ValueError(f"Unsupported artifact version {manifest['version']} "
+                         f"(the latest supported one is {ARTIFACT_VERSION})")
+    arrays_dir = os.path.join(output_path, manifest['arrays_dir'])
+    with open(os.path.join(output_path, manifest['object']), 'rb') as file:
+        return _ArtifactUnpickler(file, arrays_dir, manifest['arrays'], mmap_mode).load()
@@ -11,5 +11,5 @@ setuptools.setup(name='herc_challenge_common',
       long_description=readme_contents,
       long_description_content_type="text/markdown",
       packages = setuptools.find_packages(),
-      python_requires='>=3.6'
+      python_requires='>=3.7'
 )